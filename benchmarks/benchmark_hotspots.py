@@ -0,0 +1,217 @@
+"""Micro-benchmarks of the CPU hot spots of RARR.
+
+Benchmarks chunking batches of pages of growing size into passages with each sentence
+splitter, the cross-encoder passage ranker at several batch sizes and thread counts,
+and `evidence_selection.select_evidences` as the number of evidences grows. Inputs are
+built with fixed seeds from the sentences and claims bundled in `benchmarks/data`, so
+results are comparable across versions. Each measurement is printed as a line of JSON.
+
+Run from the root of the repository:
+    python -m benchmarks.benchmark_hotspots --benchmarks chunk_text select_evidences
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, Iterator, List
+
+from utils import evidence_selection, jsonl_io, models, search
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+BENCHMARKS = ("chunk_text", "ranker", "select_evidences")
+
+
+def load_sentences() -> List[str]:
+    """Loads the bundled pool of synthetic sentences."""
+    with open(os.path.join(DATA_DIR, "sentences.txt"), encoding="utf-8") as reader:
+        return [line.strip() for line in reader if line.strip()]
+
+
+def load_queries() -> List[str]:
+    """Loads the bundled claims, used as queries."""
+    claims_file = os.path.join(DATA_DIR, "claims.jsonl")
+    return [line["input_info"]["claim"] for line in jsonl_io.read_jsonl(claims_file)]
+
+
+def make_pages(num_pages: int, page_chars: int, seed: int = 0) -> List[str]:
+    """Builds the text of pages by sampling sentences until each is long enough."""
+    rng = random.Random(seed)
+    sentences = load_sentences()
+    pages = []
+    for _ in range(num_pages):
+        sents, num_chars = [], 0
+        while num_chars < page_chars:
+            sents.append(rng.choice(sentences))
+            num_chars += len(sents[-1]) + 1
+        pages.append(" ".join(sents))
+    return pages
+
+
+def time_fn(fn: Callable[[], Any], num_repeats: int) -> Dict[str, float]:
+    """Times `fn` after one warm-up call, returning the median and best seconds."""
+    fn()
+    timings = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"median_seconds": statistics.median(timings), "min_seconds": min(timings)}
+
+
+def benchmark_chunk_text(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Times chunking a batch of pages into passages, for each page size and splitter.
+
+    The pages are split into sentences in one batch, as `search.get_segmentations`
+    does for the pages of a claim, and each page is then chunked into passages.
+    """
+    for page_chars in args.page_chars:
+        pages = make_pages(args.num_pages, page_chars, seed=args.seed)
+        for sentence_splitter in args.sentence_splitters:
+
+            def chunk_pages() -> int:
+                sents_per_page = search.split_sentences(
+                    pages,
+                    filter_sentence_len=250,
+                    sentence_splitter=sentence_splitter,
+                    n_process=args.n_process,
+                )
+                return sum(
+                    len(search.make_passages(sents, 4, 1)) for sents in sents_per_page
+                )
+
+            timing = time_fn(chunk_pages, args.num_repeats)
+            yield {
+                "page_chars": page_chars,
+                "num_pages": len(pages),
+                "sentence_splitter": sentence_splitter,
+                "n_process": args.n_process,
+                **timing,
+                "chars_per_second": sum(map(len, pages)) / timing["median_seconds"],
+                "passages_per_second": chunk_pages() / timing["median_seconds"],
+            }
+
+
+def benchmark_ranker(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Times scoring (query, passage) pairs for each batch size and thread count."""
+    import torch
+
+    rng = random.Random(args.seed)
+    sentences = load_sentences()
+    queries = load_queries()
+    pairs = [
+        (rng.choice(queries), " ".join(rng.sample(sentences, 4)))
+        for _ in range(args.num_pairs)
+    ]
+    ranker = models.get_passage_ranker()
+    for num_threads in args.num_threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in args.batch_sizes:
+            timing = time_fn(
+                lambda: ranker.predict(
+                    pairs, batch_size=batch_size, show_progress_bar=False
+                ),
+                args.num_repeats,
+            )
+            yield {
+                "num_pairs": len(pairs),
+                "batch_size": batch_size,
+                "num_threads": num_threads,
+                "device": str(getattr(ranker, "_target_device", "unknown")),
+                **timing,
+                "pairs_per_second": len(pairs) / timing["median_seconds"],
+            }
+
+
+def make_selection_example(
+    num_questions: int, num_evidences: int, seed: int
+) -> Dict[str, Any]:
+    """Builds a RARR result whose evidences were all scored during retrieval.
+
+    Since every (question, evidence) score is known, timing `select_evidences` on it
+    measures the selection itself rather than the cross-encoder.
+    """
+    rng = random.Random(seed)
+    sentences = load_sentences()
+    questions = rng.sample(load_queries(), num_questions)
+    evidence_texts = [" ".join(rng.sample(sentences, 3)) for _ in range(num_evidences)]
+    evidences_for_questions = [
+        [
+            {"query": question, "text": text, "retrieval_score": rng.gauss(0, 3)}
+            for text in evidence_texts
+        ]
+        for question in questions
+    ]
+    return {
+        "questions": questions,
+        "evidences_for_questions": evidences_for_questions,
+        "revisions": [
+            {
+                "evidences": [
+                    evids[i % num_questions]
+                    for i, evids in enumerate(zip(*evidences_for_questions))
+                ]
+            }
+        ],
+    }
+
+
+def benchmark_select_evidences(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Times evidence selection as the number of evidences grows."""
+    for num_evidences in args.num_evidences:
+        example = make_selection_example(args.num_questions, num_evidences, args.seed)
+        for exact in (False, True):
+            if exact and num_evidences > args.max_exact_evidences:
+                continue  # Exact selection is exponential in the number of evidences.
+            timing = time_fn(
+                lambda: evidence_selection.select_evidences(example, exact=exact),
+                args.num_repeats,
+            )
+            yield {
+                "num_questions": args.num_questions,
+                "num_evidences": num_evidences,
+                "exact": exact,
+                **timing,
+            }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--benchmarks", default=BENCHMARKS, choices=BENCHMARKS, nargs="+"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--num_repeats", default=5, type=int)
+    parser.add_argument(
+        "--page_chars", default=[1000, 10000, 100000, 500000], type=int, nargs="+"
+    )
+    parser.add_argument("--num_pages", default=1, type=int)
+    parser.add_argument("--n_process", default=1, type=int)
+    parser.add_argument(
+        "--sentence_splitters", default=search.SENTENCE_SPLITTERS, nargs="+"
+    )
+    parser.add_argument("--num_pairs", default=256, type=int)
+    parser.add_argument("--batch_sizes", default=[8, 32, 128], type=int, nargs="+")
+    parser.add_argument("--num_threads", default=[1, 4], type=int, nargs="+")
+    parser.add_argument("--num_questions", default=5, type=int)
+    parser.add_argument(
+        "--num_evidences", default=[5, 10, 20, 50, 100], type=int, nargs="+"
+    )
+    parser.add_argument("--max_exact_evidences", default=20, type=int)
+    args = parser.parse_args()
+
+    benchmark_fns = {
+        "chunk_text": benchmark_chunk_text,
+        "ranker": benchmark_ranker,
+        "select_evidences": benchmark_select_evidences,
+    }
+    environment = {"python": platform.python_version(), "machine": platform.machine()}
+    for name in args.benchmarks:
+        for result in benchmark_fns[name](args):
+            print(json.dumps({"benchmark": name, **result, **environment}))
+
+
+if __name__ == "__main__":
+    main()
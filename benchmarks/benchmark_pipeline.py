@@ -0,0 +1,147 @@
+"""Benchmarks the RARR pipeline end-to-end without API keys or network access.
+
+OpenAI, Bing and the web are replaced by the local stand-ins of
+`benchmarks.fake_services`, so that performance changes can be measured on a CPU-only
+box. Reports claims per second, the p50/p95/p99 latency of each stage and the peak RSS.
+
+Run from the root of the repository, either on single claims or through `main()` (any
+unknown argument is passed on to `run_editor_sequential.py`):
+    python -m benchmarks.benchmark_pipeline --mode instance --num_claims 20
+    python -m benchmarks.benchmark_pipeline --mode main --num_claims 100 --use_asyncio
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+import run_editor_sequential
+from benchmarks import fake_services
+from utils import jsonl_io, metrics, models
+
+CLAIMS_FILE = os.path.join(os.path.dirname(__file__), "data", "claims.jsonl")
+
+
+def score_passages_lexically(pairs: List[Tuple[str, str]]) -> List[float]:
+    """Scores passages by word overlap, standing in for the cross-encoder ranker."""
+    return [
+        float(len(set(query.lower().split()) & set(passage.lower().split())))
+        for query, passage in pairs
+    ]
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process in megabytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes while macOS reports bytes.
+    return max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3
+
+
+def load_claims(path: str, num_claims: int) -> List[Dict[str, Any]]:
+    """Loads `num_claims` input lines, cycling through the file if it is shorter."""
+    lines = list(jsonl_io.read_jsonl(path))
+    return list(itertools.islice(itertools.cycle(lines), num_claims))
+
+
+def benchmark_instances(
+    lines: List[Dict[str, Any]], sentence_splitter: str
+) -> metrics.RunSummary:
+    """Runs `run_editor_one_instance` on each claim, one after the other."""
+    run_summary = metrics.RunSummary()
+    for line in lines:
+        with metrics.collect() as claim_metrics, metrics.track("claim"):
+            run_editor_sequential.run_editor_one_instance(
+                claim=line["input_info"]["claim"], sentence_splitter=sentence_splitter
+            )
+        run_summary.add_claim(claim_metrics.to_dict())
+    return run_summary
+
+
+def benchmark_main(
+    lines: List[Dict[str, Any]], sentence_splitter: str, main_args: List[str]
+) -> metrics.RunSummary:
+    """Runs `run_editor_sequential.main` on a file of the claims."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, "input.jsonl")
+        output_file = os.path.join(tmp_dir, "output.jsonl")
+        with open(input_file, "w", encoding="utf-8") as writer:
+            for line in lines:
+                writer.write(json.dumps(line) + "\n")
+
+        run_summary = metrics.RunSummary()
+        sys.argv = [
+            "run_editor_sequential.py",
+            f"--input_file={input_file}",
+            f"--output_file={output_file}",
+            "--claim_field=claim",
+            f"--sentence_splitter={sentence_splitter}",
+            *main_args,
+        ]
+        run_editor_sequential.main()
+        for line in jsonl_io.read_jsonl(output_file):
+            run_summary.add_claim(line["metrics"])
+    return run_summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="instance", choices=["instance", "main"])
+    parser.add_argument("--claims_file", default=CLAIMS_FILE, type=str)
+    parser.add_argument("--num_claims", default=20, type=int)
+    parser.add_argument("--openai_latency_ms", default=50, type=float)
+    parser.add_argument("--bing_latency_ms", default=20, type=float)
+    parser.add_argument("--page_latency_ms", default=20, type=float)
+    parser.add_argument("--gate_open_rate", default=0.3, type=float)
+    parser.add_argument("--num_pages", default=50, type=int)
+    parser.add_argument("--page_chars", default=20000, type=int)
+    parser.add_argument(
+        "--ranker",
+        default="lexical",
+        choices=["lexical", "cross_encoder"],
+        help="The cross-encoder needs its weights to be downloaded or cached.",
+    )
+    parser.add_argument("--sentence_splitter", default="regex", type=str)
+    args, main_args = parser.parse_known_args()
+
+    if args.ranker == "lexical":
+        models.score_passages = score_passages_lexically
+    process = fake_services.start_fake_services(
+        openai_latency_ms=args.openai_latency_ms,
+        bing_latency_ms=args.bing_latency_ms,
+        page_latency_ms=args.page_latency_ms,
+        gate_open_rate=args.gate_open_rate,
+        num_pages=args.num_pages,
+        page_chars=args.page_chars,
+    )
+    try:
+        lines = load_claims(args.claims_file, args.num_claims)
+        if args.mode == "instance":
+            run_summary = benchmark_instances(lines, args.sentence_splitter)
+        else:
+            run_summary = benchmark_main(lines, args.sentence_splitter, main_args)
+    finally:
+        process.terminate()
+
+    summary = run_summary.summarize()
+    result = {
+        "mode": args.mode,
+        "num_claims": summary["num_claims"],
+        "claims_per_second": summary["claims_per_second"],
+        "peak_rss_mb": get_peak_rss_mb(),
+        "stages": {
+            stage: {
+                name: value
+                for name, value in stats.items()
+                if name.endswith("_seconds") or name == "total_calls"
+            }
+            for stage, stats in summary["stages"].items()
+        },
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Benchmarks the passage ranker backends and checks their scores against fp32.
+
+Each backend scores the same (query, passage) pairs, built with a fixed seed from the
+data bundled in `benchmarks/data`, with `num_passages_per_query` candidate passages per
+query as in retrieval. Its throughput is reported along with how closely its scores
+match those of the fp32 "torch" backend: the largest absolute difference, the Spearman
+correlation, and the fraction of queries whose top passage is unchanged (which is what
+retrieval keeps). Each backend is printed as a line of JSON, and the process exits with
+an error if a backend falls below `--min_top1_agreement`.
+
+Run from the root of the repository:
+    python -m benchmarks.benchmark_ranker_backends --backends torch torch_int8 onnx_int8
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from benchmarks.benchmark_hotspots import load_queries, load_sentences, time_fn
+from utils import models
+
+
+def make_pairs(
+    num_queries: int, num_passages_per_query: int, seed: int
+) -> List[Tuple[str, str]]:
+    """Builds the candidate (query, passage) pairs of each query, grouped by query."""
+    rng = random.Random(seed)
+    sentences = load_sentences()
+    queries = load_queries()
+    return [
+        (query, " ".join(rng.sample(sentences, 4)))
+        for query in rng.choices(queries, k=num_queries)
+        for _ in range(num_passages_per_query)
+    ]
+
+
+def get_ranks(values: np.ndarray) -> np.ndarray:
+    """Returns the rank of each value."""
+    ranks = np.empty(len(values))
+    ranks[np.argsort(values)] = np.arange(len(values))
+    return ranks
+
+
+def compare_scores(
+    reference: np.ndarray, scores: np.ndarray, num_passages_per_query: int
+) -> Dict[str, float]:
+    """Measures how closely the scores of a backend match the reference scores."""
+    spearman = np.corrcoef(get_ranks(reference), get_ranks(scores))[0, 1]
+    top1_reference = reference.reshape(-1, num_passages_per_query).argmax(axis=1)
+    top1 = scores.reshape(-1, num_passages_per_query).argmax(axis=1)
+    return {
+        "max_abs_diff": float(np.abs(reference - scores).max()),
+        "spearman": float(spearman),
+        "top1_agreement": float((top1_reference == top1).mean()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backends",
+        default=models.PASSAGE_RANKER_BACKENDS,
+        choices=models.PASSAGE_RANKER_BACKENDS,
+        nargs="+",
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--num_queries", default=32, type=int)
+    parser.add_argument("--num_passages_per_query", default=16, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--num_repeats", default=3, type=int)
+    parser.add_argument("--min_top1_agreement", default=0.9, type=float)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    pairs = make_pairs(args.num_queries, args.num_passages_per_query, args.seed)
+    environment = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+    # The fp32 backend is always run first, as the reference.
+    reference = None
+    failed_backends = []
+    for backend in ["torch"] + [b for b in args.backends if b != "torch"]:
+        ranker = models.load_passage_ranker(backend=backend, device="cpu")
+        scores = np.asarray(
+            ranker.predict(pairs, batch_size=args.batch_size, show_progress_bar=False)
+        )
+        if reference is None:
+            reference = scores
+        parity = compare_scores(reference, scores, args.num_passages_per_query)
+        if parity["top1_agreement"] < args.min_top1_agreement:
+            failed_backends.append(backend)
+
+        timing = time_fn(
+            lambda: ranker.predict(
+                pairs, batch_size=args.batch_size, show_progress_bar=False
+            ),
+            args.num_repeats,
+        )
+        if backend in args.backends:
+            result: Dict[str, Any] = {
+                "backend": backend,
+                "num_pairs": len(pairs),
+                "batch_size": args.batch_size,
+                **timing,
+                "pairs_per_second": len(pairs) / timing["median_seconds"],
+                **parity,
+            }
+            print(json.dumps({**result, **environment}))
+
+    if failed_backends:
+        sys.exit(
+            f"Top passages of {', '.join(failed_backends)} agree with fp32 for less "
+            f"than {args.min_top1_agreement:.0%} of queries."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Local stand-ins for the OpenAI completions API, Bing and the web, for benchmarking.
+
+A single threaded HTTP server answers:
+    POST /v1/completions: canned completions matching the format each RARR prompt
+        expects, so question generation, agreement gating, editing and evidence
+        hallucination all parse successfully.
+    GET /bing: Bing-style search results pointing at pages of the local corpus.
+    GET /pages/<i>.html: a static corpus of HTML pages generated from a fixed seed.
+Each endpoint waits for a configurable latency before answering, so benchmarks reflect
+a pipeline that is bound by network round trips without needing network access.
+"""
+import http.server
+import json
+import multiprocessing
+import random
+import re
+import time
+import urllib.parse
+import zlib
+from typing import Any, Dict, List
+
+import openai
+
+from benchmarks.benchmark_hotspots import make_pages
+from utils import search
+
+HTML_TEMPLATE = (
+    "<html><head><title>Page {page_idx}</title><style>p {{ margin: 0; }}</style>"
+    "<script>var page = {page_idx};</script></head><body><h1>Page {page_idx}</h1>"
+    "{paragraphs}<footer>Footer of page {page_idx}</footer></body></html>"
+)
+
+
+def make_html_corpus(num_pages: int, page_chars: int, seed: int = 0) -> List[bytes]:
+    """Generates HTML pages whose visible text is made of random sentences."""
+    pages = []
+    for page_idx, text in enumerate(make_pages(num_pages, page_chars, seed=seed)):
+        sents = text.split(". ")
+        paragraphs = "".join(
+            f"<p>{'. '.join(sents[i : i + 5])}.</p>" for i in range(0, len(sents), 5)
+        )
+        html = HTML_TEMPLATE.format(page_idx=page_idx, paragraphs=paragraphs)
+        pages.append(html.encode("utf-8"))
+    return pages
+
+
+def stable_hash(text: str) -> int:
+    """Hashes text the same way in every process, unlike the built-in `hash`."""
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def make_completion_text(prompt: str, choice_idx: int, gate_open_rate: float) -> str:
+    """Returns a canned completion in the format expected for the prompt."""
+    claims = re.findall(r"You said: (.*)", prompt)
+    claim = claims[-1].strip() if claims else ""
+    if prompt.endswith("To verify it,"):
+        rng = random.Random(stable_hash(claim) + choice_idx)
+        words = re.findall(r"\w+", claim) or ["it"]
+        questions = [
+            "What is " + " ".join(rng.sample(words, min(2, len(words)))) + "?"
+            for _ in range(3)
+        ]
+        return "\n" + "\n".join(
+            f"{i + 1}. I googled: {question}" for i, question in enumerate(questions)
+        )
+    if prompt.endswith("Reasoning:"):
+        is_open = stable_hash(prompt) % 1000 < gate_open_rate * 1000
+        decision = "disagrees" if is_open else "agrees"
+        return (
+            " The article and what you said are compared.\n"
+            f"5. Therefore: This {decision} with what you said."
+        )
+    if prompt.endswith("This suggests"):
+        return (
+            " a detail in your statement is wrong.\n"
+            f"5. My fix: {claim.rstrip('.')}, according to the article."
+        )
+    if prompt.endswith("Text:"):
+        return " A generated paragraph that answers the question."
+    return " Unknown prompt."
+
+
+class FakeServiceHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests to all fake services, configured by `serve`."""
+
+    config: Dict[str, Any] = {}
+    pages: List[bytes] = []
+
+    def log_message(self, *args: Any) -> None:
+        pass  # Keep the benchmark output clean.
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.config["openai_latency_ms"] / 1000)
+        prompt = request["prompt"]
+        texts = [
+            make_completion_text(prompt, choice_idx, self.config["gate_open_rate"])
+            for choice_idx in range(request.get("n", 1))
+        ]
+        response = {
+            "id": "cmpl-fake",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [
+                {"text": text, "index": i, "logprobs": None, "finish_reason": "stop"}
+                for i, text in enumerate(texts)
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": sum(len(text) for text in texts) // 4,
+                "total_tokens": (len(prompt) + sum(len(text) for text in texts)) // 4,
+            },
+        }
+        self.send_body(json.dumps(response).encode("utf-8"), "application/json")
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/bing":
+            time.sleep(self.config["bing_latency_ms"] / 1000)
+            query = urllib.parse.parse_qs(url.query)["q"][0]
+            rng = random.Random(stable_hash(query))
+            page_idxs = rng.sample(
+                range(len(self.pages)),
+                min(self.config["results_per_query"], len(self.pages)),
+            )
+            base_url = f"http://{self.headers['Host']}"
+            results = {
+                "webPages": {
+                    "value": [{"url": f"{base_url}/pages/{i}.html"} for i in page_idxs]
+                }
+            }
+            self.send_body(json.dumps(results).encode("utf-8"), "application/json")
+        elif url.path.startswith("/pages/"):
+            time.sleep(self.config["page_latency_ms"] / 1000)
+            page_idx = int(url.path[len("/pages/") :].split(".")[0])
+            self.send_body(self.pages[page_idx], "text/html; charset=utf-8")
+        else:
+            self.send_error(404)
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """Serves each request in its own thread."""
+
+    daemon_threads = True
+    # The default backlog of 5 drops the connections of concurrent scrapes, which
+    # then only connect after a retransmission timeout of a second.
+    request_queue_size = 1024
+
+
+def serve(config: Dict[str, Any], port_queue: multiprocessing.Queue) -> None:
+    """Runs the fake services until the process is terminated.
+
+    Args:
+        config: The arguments of `start_fake_services`.
+        port_queue: Queue to send the port the server listens on to the parent.
+    """
+    FakeServiceHandler.config = config
+    FakeServiceHandler.pages = make_html_corpus(
+        config["num_pages"], config["page_chars"]
+    )
+    server = FakeServer(("127.0.0.1", 0), FakeServiceHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_services(
+    openai_latency_ms: float = 50,
+    bing_latency_ms: float = 20,
+    page_latency_ms: float = 20,
+    gate_open_rate: float = 0.3,
+    results_per_query: int = 5,
+    num_pages: int = 50,
+    page_chars: int = 20000,
+) -> multiprocessing.Process:
+    """Starts the fake services and points the OpenAI client and Bing search at them.
+
+    The services run in a separate process so that they neither compete with the
+    pipeline for the GIL nor count towards its memory usage.
+
+    Args:
+        openai_latency_ms: Latency of each completion request.
+        bing_latency_ms: Latency of each search request.
+        page_latency_ms: Latency of each web page request.
+        gate_open_rate: Fraction of agreement gates that open, leading to an edit.
+        results_per_query: Number of pages returned for each search.
+        num_pages: Number of pages in the corpus.
+        page_chars: Number of characters of text of each page.
+    Returns:
+        process: The process running the services. Terminate it when done.
+    """
+    config = dict(
+        openai_latency_ms=openai_latency_ms,
+        bing_latency_ms=bing_latency_ms,
+        page_latency_ms=page_latency_ms,
+        gate_open_rate=gate_open_rate,
+        results_per_query=results_per_query,
+        num_pages=num_pages,
+        page_chars=page_chars,
+    )
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(config, port_queue), daemon=True
+    )
+    process.start()
+
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+    openai.api_base = f"{base_url}/v1"
+    openai.api_key = "fake-key"
+    search.SEARCH_URL = f"{base_url}/bing"
+    search.SUBSCRIPTION_KEY = "fake-key"
+    return process
@@ -4,22 +4,45 @@ Runs question generation, retrieval, agreement gate, and editing on a file with
 using GPT-3 and Bing.
 """
 import argparse
+import asyncio
+import collections
+import concurrent.futures
 import json
 import os
-from typing import Any, Dict
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
-import jsonlines
+import aiohttp
 import Levenshtein
+import openai
 import tqdm
 
 from prompts import hallucination_prompts, rarr_prompts
 from utils import (
     agreement_gate,
+    async_utils,
+    cache,
     editor,
     evidence_selection,
     hallucination,
+    jsonl_io,
+    llm,
+    metrics,
+    models,
+    prefilter,
     search,
     question_generation,
+    work_queue,
 )
 
 
@@ -38,7 +61,7 @@ def raise_hallucinate_evidence_warning():
 raise_hallucinate_evidence_warning.called = False
 
 
-def run_editor_one_instance(
+async def arun_editor_one_instance(
     claim: str,
     context: str = None,
     model: str = "text-davinci-003",
@@ -51,6 +74,13 @@ def run_editor_one_instance(
     max_evidences_per_question: int = 1,
     max_edit_ratio: float = 100,
     hallucinate_evidence: bool = False,
+    exact_evidence_selection: bool = False,
+    evidence_scorer: str = "cross_encoder",
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+    html_extractor: str = "auto",
+    passage_prefilter: str = "bm25",
+    speculative_gating: bool = False,
 ) -> Dict[str, Any]:
     """Runs query generation, search, agreement gating, and editing on a claim.
 
@@ -67,6 +97,20 @@ def run_editor_one_instance(
             each search result. A passage ranker is applied first.
         max_evidences_per_question: Maximum number of evidences to return per question.
         max_edit_ratio: Maximum edit ratio between claim and edit for each round.
+        exact_evidence_selection: Whether to search all subsets of evidence for the
+            attribution report instead of selecting evidences greedily.
+        evidence_scorer: How to score evidences against questions for the attribution
+            report: "cross_encoder" with the passage ranker, or "bm25" lexically.
+        sentence_splitter: How to split search results into sentences. One of
+            "parser", "sentencizer" or "regex", from most accurate to fastest.
+        n_process: Number of processes spaCy uses to split search results.
+        html_extractor: How to extract text from web pages: "lxml", "bs4", or "auto"
+            to use lxml if installed.
+        passage_prefilter: How to choose the passages of long search results to rank:
+            "bm25" for the most lexically relevant ones, or "position" for the first.
+        speculative_gating: Whether to run the agreement gates of all evidences
+            concurrently against the current claim, only gating the evidences after
+            an edit again. Gives the same revisions as gating one evidence at a time.
     Returns:
         result: All revision information, including the queries generated, search
             results, agreement gate information, and each revision step done on the
@@ -76,41 +120,47 @@ def run_editor_one_instance(
     agreement_gates = []
 
     # Generate questions for the claim
-    questions = question_generation.run_rarr_question_generation(
-        claim=claim,
-        context=context,
-        model=model,
-        prompt=rarr_prompts.CONTEXTUAL_QGEN_PROMPT
-        if context
-        else rarr_prompts.QGEN_PROMPT,
-        temperature=temperature_qgen,
-        num_rounds=num_rounds_qgen,
-    )
+    with metrics.track("question_generation"):
+        questions = await question_generation.arun_rarr_question_generation(
+            claim=claim,
+            context=context,
+            model=model,
+            prompt=rarr_prompts.CONTEXTUAL_QGEN_PROMPT
+            if context
+            else rarr_prompts.QGEN_PROMPT,
+            temperature=temperature_qgen,
+            num_rounds=num_rounds_qgen,
+        )
 
     # Run search on generated question for the claim
     if hallucinate_evidence:
         raise_hallucinate_evidence_warning()
-        evidences_for_questions = [
-            [
-                hallucination.run_evidence_hallucination(
-                    query=query,
-                    model=model,
-                    prompt=hallucination_prompts.EVIDENCE_HALLUCINATION,
+        with metrics.track("hallucination", calls=len(questions)):
+            hallucinated_evidences = await asyncio.gather(
+                *(
+                    hallucination.arun_evidence_hallucination(
+                        query=query,
+                        model=model,
+                        prompt=hallucination_prompts.EVIDENCE_HALLUCINATION,
+                    )
+                    for query in questions
                 )
-            ]
-            for query in questions
-        ]
+            )
+        evidences_for_questions = [[evid] for evid in hallucinated_evidences]
     else:
-        evidences_for_questions = [
-            search.run_search(
-                query=query,
+        # Passages of all questions are ranked together in one batched call.
+        with metrics.track("search"):
+            evidences_for_questions = await search.arun_searches(
+                queries=questions,
                 max_search_results_per_query=max_search_results_per_query,
                 max_sentences_per_passage=max_sentences_per_passage,
                 sliding_distance=sliding_distance,
                 max_passages_per_search_result_to_return=max_passages_per_search_result,
+                sentence_splitter=sentence_splitter,
+                n_process=n_process,
+                html_extractor=html_extractor,
+                passage_prefilter=passage_prefilter,
             )
-            for query in questions
-        ]
 
     # Flatten the evidences per question into a single list.
     used_evidences = [
@@ -120,10 +170,9 @@ def run_editor_one_instance(
     ]
 
     # Iterative editing over each evidence
-    revision_steps = []
-    for evid in used_evidences:
-        # Run the agreement gate on the current (claim, context, query, evidence) tuple
-        gate = agreement_gate.run_agreement_gate(
+    def run_gate(claim: str, evid: Dict[str, Any]) -> Awaitable[Dict[str, Any]]:
+        """Runs the agreement gate on a (claim, context, query, evidence) tuple."""
+        return agreement_gate.arun_agreement_gate(
             claim=claim,
             context=context,
             query=evid["query"],
@@ -133,26 +182,51 @@ def run_editor_one_instance(
             if context
             else rarr_prompts.AGREEMENT_GATE_PROMPT,
         )
-        agreement_gates.append(gate)
-
-        # Run the editor gate if the agreement gate is open
-        if gate["is_open"]:
-            edited_claim = editor.run_rarr_editor(
-                claim=claim,
-                context=context,
-                query=evid["query"],
-                evidence=evid["text"],
-                model=model,
-                prompt=rarr_prompts.CONTEXTUAL_EDITOR_PROMPT
-                if context
-                else rarr_prompts.EDITOR_PROMPT,
-            )["text"]
-
-            # Don't keep the edit if the editor makes a huge change
-            if Levenshtein.distance(claim, edited_claim) / len(claim) <= max_edit_ratio:
-                claim = edited_claim
-
-        revision_steps.append({"text": claim})
+
+    revision_steps = []
+    while len(revision_steps) < len(used_evidences):
+        remaining_evidences = used_evidences[len(revision_steps) :]
+        if speculative_gating:
+            # Gate all remaining evidences against the current claim at once. The
+            # gates are only valid up to the next edit, after which the evidences
+            # that follow are gated again against the edited claim.
+            with metrics.track("agreement_gate", calls=len(remaining_evidences)):
+                gates = await asyncio.gather(
+                    *(run_gate(claim, evid) for evid in remaining_evidences)
+                )
+        else:
+            with metrics.track("agreement_gate"):
+                gates = [await run_gate(claim, remaining_evidences[0])]
+
+        for evid, gate in zip(remaining_evidences, gates):
+            agreement_gates.append(gate)
+            previous_claim = claim
+
+            # Run the editor gate if the agreement gate is open
+            if gate["is_open"]:
+                with metrics.track("editor"):
+                    edited = await editor.arun_rarr_editor(
+                        claim=claim,
+                        context=context,
+                        query=evid["query"],
+                        evidence=evid["text"],
+                        model=model,
+                        prompt=rarr_prompts.CONTEXTUAL_EDITOR_PROMPT
+                        if context
+                        else rarr_prompts.EDITOR_PROMPT,
+                    )
+                edited_claim = edited["text"]
+
+                # Don't keep the edit if the editor makes a huge change
+                if (
+                    Levenshtein.distance(claim, edited_claim) / len(claim)
+                    <= max_edit_ratio
+                ):
+                    claim = edited_claim
+
+            revision_steps.append({"text": claim})
+            if claim != previous_claim:
+                break
 
     result = {
         "context": context,
@@ -162,18 +236,74 @@ def run_editor_one_instance(
         "revisions": [
             {
                 "original_text": original_claim,
-                "revised_text": revision_steps[-1]["text"],
+                "revised_text": claim,
                 "evidences": used_evidences,
                 "agreement_gates": agreement_gates,
                 "revision_steps": revision_steps,
             }
         ],
     }
-    selected_evidences = evidence_selection.select_evidences(result)
+    with metrics.track("evidence_selection"):
+        selected_evidences = await async_utils.run_in_thread(
+            evidence_selection.select_evidences,
+            result,
+            exact=exact_evidence_selection,
+            scorer=evidence_scorer,
+        )
     result["selected_evidences"] = selected_evidences
     return result
 
 
+def run_editor_one_instance(
+    claim: str,
+    context: str = None,
+    model: str = "text-davinci-003",
+    temperature_qgen: float = 0.7,
+    num_rounds_qgen: int = 3,
+    max_search_results_per_query: int = 5,
+    max_sentences_per_passage: int = 4,
+    sliding_distance: int = 1,
+    max_passages_per_search_result: int = 1,
+    max_evidences_per_question: int = 1,
+    max_edit_ratio: float = 100,
+    hallucinate_evidence: bool = False,
+    exact_evidence_selection: bool = False,
+    evidence_scorer: str = "cross_encoder",
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+    html_extractor: str = "auto",
+    passage_prefilter: str = "bm25",
+    speculative_gating: bool = False,
+) -> Dict[str, Any]:
+    """Runs query generation, search, agreement gating, and editing on a claim.
+
+    Synchronous wrapper around `arun_editor_one_instance`, see it for the arguments.
+    """
+    return async_utils.run(
+        arun_editor_one_instance(
+            claim,
+            context=context,
+            model=model,
+            temperature_qgen=temperature_qgen,
+            num_rounds_qgen=num_rounds_qgen,
+            max_search_results_per_query=max_search_results_per_query,
+            max_sentences_per_passage=max_sentences_per_passage,
+            sliding_distance=sliding_distance,
+            max_passages_per_search_result=max_passages_per_search_result,
+            max_evidences_per_question=max_evidences_per_question,
+            max_edit_ratio=max_edit_ratio,
+            hallucinate_evidence=hallucinate_evidence,
+            exact_evidence_selection=exact_evidence_selection,
+            evidence_scorer=evidence_scorer,
+            sentence_splitter=sentence_splitter,
+            n_process=n_process,
+            html_extractor=html_extractor,
+            passage_prefilter=passage_prefilter,
+            speculative_gating=speculative_gating,
+        )
+    )
+
+
 def get_args() -> argparse.Namespace:
     """Gets command line arguments."""
     parser = argparse.ArgumentParser()
@@ -252,6 +382,53 @@ def get_args() -> argparse.Namespace:
         help="Maximum number of passages to return for each search result. A passage"
         " ranker is applied to get the top passages per query.",
     )
+    parser.add_argument(
+        "--sentence_splitter",
+        default="parser",
+        choices=search.SENTENCE_SPLITTERS,
+        help="How to split search results into sentences: spaCy's dependency parser, "
+        "spaCy's rule-based sentencizer, or a regex. Ordered from most accurate to "
+        "fastest.",
+    )
+    parser.add_argument(
+        "--passage_prefilter",
+        default="bm25",
+        choices=prefilter.PASSAGE_PREFILTERS,
+        help="How to choose which passages of a long search result to rank: the most "
+        "relevant to the query by BM25, or the first ones.",
+    )
+    parser.add_argument(
+        "--spacy_n_process",
+        default=1,
+        type=int,
+        help="Number of processes spaCy uses to split the search results of a query.",
+    )
+    parser.add_argument(
+        "--html_extractor",
+        default="auto",
+        choices=["auto", "lxml", "bs4"],
+        help="How to extract text from web pages. lxml is faster and is used by "
+        "default when installed; BeautifulSoup is the fallback.",
+    )
+    parser.add_argument(
+        "--max_connections_per_host",
+        default=10,
+        type=int,
+        help="Maximum number of open HTTP connections to each host.",
+    )
+    parser.add_argument(
+        "--max_page_bytes",
+        default=5000000,
+        type=int,
+        help="Maximum number of bytes to download from each web page. Pages declaring "
+        "a larger size are skipped.",
+    )
+    parser.add_argument(
+        "--max_fetch_seconds",
+        default=10,
+        type=float,
+        help="Maximum number of seconds to spend downloading each web page.",
+    )
     parser.add_argument(
         "--max_evidences_per_question",
         default=1,
@@ -264,12 +441,213 @@ def get_args() -> argparse.Namespace:
         type=float,
         help="Maximum edit ratio between claim and edit for each round.",
     )
+    parser.add_argument(
+        "--num_workers",
+        default=1,
+        type=int,
+        help="Number of claims to run concurrently. Output lines are still written in "
+        "the order of the input file.",
+    )
+    parser.add_argument(
+        "--max_claims_in_flight",
+        default=None,
+        type=int,
+        help="Maximum number of claims submitted but not yet written. Defaults to "
+        "4 * num_workers. Bounds memory when a slow claim blocks the output order.",
+    )
+    parser.add_argument(
+        "--exact_evidence_selection",
+        action="store_true",
+        help="Searches all subsets of evidence for the attribution report instead of "
+        "selecting evidences greedily. Exponential in the number of evidences.",
+    )
+    parser.add_argument(
+        "--evidence_scorer",
+        default="cross_encoder",
+        choices=evidence_selection.EVIDENCE_SCORERS,
+        help="How to score evidences against questions for the attribution report. "
+        "bm25 is lexical and never loads the passage ranker, e.g., when evidence is "
+        "hallucinated.",
+    )
+    parser.add_argument(
+        "--speculative_gating",
+        action="store_true",
+        help="Runs the agreement gates of all evidences of a claim concurrently, "
+        "re-running the gates after each edit. Same results, fewer round trips.",
+    )
+    parser.add_argument(
+        "--ranker_device",
+        default=None,
+        type=str,
+        help="Device to run the passage ranker on (e.g., cpu, cuda). Defaults to a "
+        "GPU if available.",
+    )
+    parser.add_argument(
+        "--ranker_batch_size",
+        default=32,
+        type=int,
+        help="Number of (query, passage) pairs the passage ranker scores at once.",
+    )
+    parser.add_argument(
+        "--ranker_max_length",
+        default=512,
+        type=int,
+        help="Maximum number of tokens of each (query, passage) pair to rank.",
+    )
+    parser.add_argument(
+        "--ranker_backend",
+        default="torch",
+        choices=models.PASSAGE_RANKER_BACKENDS,
+        help="How to run the passage ranker: in fp32 with PyTorch, or quantized to "
+        "int8 on CPU with PyTorch or ONNX Runtime (requires onnx and onnxruntime). "
+        "Check the int8 scores with benchmarks/benchmark_ranker_backends.py first.",
+    )
+    parser.add_argument(
+        "--ranker_onnx_dir",
+        default=None,
+        type=str,
+        help="Directory to keep the passage ranker exported to ONNX in. Defaults to "
+        "~/.cache/rarr/onnx.",
+    )
+    parser.add_argument(
+        "--use_asyncio",
+        action="store_true",
+        help="Runs claims concurrently in a single asyncio event loop instead of a "
+        "thread pool. Allows many more claims in flight per process.",
+    )
+    parser.add_argument(
+        "--max_concurrent_claims",
+        default=64,
+        type=int,
+        help="Maximum number of claims in flight with --use_asyncio.",
+    )
+    parser.add_argument(
+        "--max_concurrent_openai_requests",
+        default=16,
+        type=int,
+        help="Maximum number of concurrent OpenAI requests with --use_asyncio.",
+    )
+    parser.add_argument(
+        "--max_concurrent_bing_requests",
+        default=8,
+        type=int,
+        help="Maximum number of concurrent Bing requests with --use_asyncio.",
+    )
+    parser.add_argument(
+        "--max_concurrent_scrapes",
+        default=64,
+        type=int,
+        help="Maximum number of web pages scraped concurrently with --use_asyncio.",
+    )
+    parser.add_argument(
+        "--openai_requests_per_minute",
+        default=None,
+        type=float,
+        help="Maximum number of OpenAI requests per minute, shared by all claims.",
+    )
+    parser.add_argument(
+        "--openai_tokens_per_minute",
+        default=None,
+        type=float,
+        help="Maximum number of OpenAI tokens (prompt + max_tokens) per minute, "
+        "shared by all claims.",
+    )
+    parser.add_argument(
+        "--completion_cache_file",
+        default=None,
+        type=str,
+        help="SQLite file to cache OpenAI completions in. Re-running with the same "
+        "file reuses completions for identical requests.",
+    )
+    parser.add_argument(
+        "--completion_cache_max_mb",
+        default=None,
+        type=float,
+        help="Maximum size of the completion cache in MB. Least recently used "
+        "completions are evicted first.",
+    )
+    parser.add_argument(
+        "--search_cache_file",
+        default=None,
+        type=str,
+        help="SQLite file to cache search results and scraped web pages in.",
+    )
+    parser.add_argument(
+        "--search_cache_max_mb",
+        default=None,
+        type=float,
+        help="Maximum size of the search cache in MB. Least recently used entries "
+        "are evicted first.",
+    )
+    parser.add_argument(
+        "--search_cache_ttl_hours",
+        default=None,
+        type=float,
+        help="Number of hours cached search results and web pages stay valid.",
+    )
     parser.add_argument(
         "--resume",
         action="store_true",
-        help="Resumes the editing process if broken by loading the output file.",
+        help="Resumes the editing process if broken. Claims already finished in the "
+        "output file are skipped, failed ones are dropped from it, and new results "
+        "are appended to it.",
+    )
+    parser.add_argument(
+        "--num_shards",
+        default=1,
+        type=int,
+        help="Number of shards the input is split into, e.g., one per machine.",
+    )
+    parser.add_argument(
+        "--shard_id",
+        default=0,
+        type=int,
+        help="Index of the shard to run, between 0 and num_shards - 1.",
+    )
+    parser.add_argument(
+        "--shard_strategy",
+        default="hash",
+        choices=["hash", "range"],
+        help="Assigns claims to shards by a hash of the claim, or by contiguous "
+        "ranges of input lines.",
+    )
+    parser.add_argument(
+        "--work_queue_file",
+        default=None,
+        type=str,
+        help="SQLite file shared by workers that lease claims from it dynamically "
+        "instead of running a fixed shard. Each worker needs its own output file.",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        default=1800,
+        type=float,
+        help="Number of seconds after which a claim leased by a worker that did not "
+        "finish it is leased again.",
+    )
+    parser.add_argument(
+        "--merge_outputs",
+        default=None,
+        nargs="+",
+        help="Instead of running RARR, merges these output files of several workers "
+        "into the output file, in the order of the input file.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        default=None,
+        type=str,
+        help="File to export the run's stage metrics to in the Prometheus text format, "
+        "e.g., for a node_exporter textfile collector. Updated every 100 claims.",
+    )
+    parser.add_argument(
+        "--fsync_every",
+        default=100,
+        type=int,
+        help="Number of output lines written between syncs of the output file to disk.",
     )
     args = parser.parse_args()
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard_id must be between 0 and num_shards - 1.")
 
     # Write all args to file
     with open(args.output_file + "_args", "w", encoding="utf-8") as writer:
@@ -277,50 +655,287 @@ def get_args() -> argparse.Namespace:
     return args
 
 
+# Failures of the APIs a claim calls, which only fail that claim. Other exceptions (e.g.,
+# a missing spaCy model) would fail every claim, so they abort the run instead.
+CLAIM_ERRORS = (
+    openai.error.OpenAIError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+def make_error_record(exception: Exception) -> Dict[str, str]:
+    """Describes why a claim failed, to write in place of its result."""
+    print(f"Failed to edit claim: {exception!r}")
+    return {"type": type(exception).__name__, "message": str(exception)}
+
+
+def ordered_parallel_map(
+    fn: Callable[[Any], Any],
+    items: Iterable[Any],
+    num_workers: int,
+    max_in_flight: Optional[int] = None,
+) -> Iterator[Any]:
+    """Applies `fn` to `items` with a thread pool, yielding results in input order.
+
+    At most `max_in_flight` items are submitted ahead of the oldest unfinished item,
+    so memory stays bounded even if a single item is much slower than the rest.
+
+    Args:
+        fn: Function to apply to each item.
+        items: Items to process.
+        num_workers: Number of worker threads.
+        max_in_flight: Maximum number of submitted but not yet yielded items.
+    Returns:
+        results: Iterator over `fn(item)` in the same order as `items`.
+    """
+    if num_workers <= 1:
+        yield from map(fn, items)
+        return
+
+    max_in_flight = max(max_in_flight or 4 * num_workers, num_workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+async def aordered_map(
+    fn: Callable[[Any], Awaitable[Any]], items: AsyncIterable[Any], max_in_flight: int
+) -> AsyncIterator[Any]:
+    """Awaits `fn` on `items` concurrently, yielding results in input order.
+
+    Args:
+        fn: Coroutine function to apply to each item.
+        items: Async iterator over the items to process.
+        max_in_flight: Maximum number of started but not yet yielded items.
+    Returns:
+        results: Async iterator over `fn(item)` in the same order as `items`.
+    """
+    tasks = collections.deque()
+    async for item in items:
+        tasks.append(asyncio.ensure_future(fn(item)))
+        if len(tasks) >= max_in_flight:
+            yield await tasks.popleft()
+    while tasks:
+        yield await tasks.popleft()
+
+
 def main() -> None:
     """Loads a RARR evaluation set and runs GPT-3 RARR editing."""
     args = get_args()
+    if args.merge_outputs:
+        num_merged, num_missing = jsonl_io.merge_outputs(
+            args.input_file,
+            args.merge_outputs,
+            args.output_file,
+            key_fn=lambda line: jsonl_io.make_key(line["input_info"][args.claim_field]),
+        )
+        print(f"Merged {num_merged} lines, {num_missing} lines have no output.")
+        return
 
-    # Load the finished results by mapping from the claim name to the results.
-    if args.resume and os.path.exists(args.output_file):
+    search.check_html_extractor(args.html_extractor)
+    models.configure_passage_ranker(
+        device=args.ranker_device,
+        batch_size=args.ranker_batch_size,
+        max_length=args.ranker_max_length,
+        backend=args.ranker_backend,
+        onnx_dir=args.ranker_onnx_dir,
+    )
+    search.configure_http(
+        max_connections_per_host=args.max_connections_per_host,
+        max_page_bytes=args.max_page_bytes,
+        max_fetch_seconds=args.max_fetch_seconds,
+    )
+    llm.configure_rate_limits(
+        requests_per_minute=args.openai_requests_per_minute,
+        tokens_per_minute=args.openai_tokens_per_minute,
+    )
+    async_utils.configure_concurrency(
+        openai=args.max_concurrent_openai_requests,
+        bing=args.max_concurrent_bing_requests,
+        scrape=args.max_concurrent_scrapes,
+    )
+    if args.completion_cache_file:
+        cache.enable_completion_cache(
+            args.completion_cache_file, max_size_mb=args.completion_cache_max_mb
+        )
+    if args.search_cache_file:
+        cache.enable_search_cache(
+            args.search_cache_file,
+            max_size_mb=args.search_cache_max_mb,
+            ttl_hours=args.search_cache_ttl_hours,
+        )
+
+    editor_kwargs = dict(
+        model=args.model,
+        temperature_qgen=args.temperature_qgen,
+        num_rounds_qgen=args.num_rounds_qgen,
+        max_search_results_per_query=args.max_search_results_per_query,
+        max_sentences_per_passage=args.max_sentences_per_passage,
+        sliding_distance=args.sliding_distance,
+        max_passages_per_search_result=args.max_passages_per_search_result,
+        max_evidences_per_question=args.max_evidences_per_question,
+        max_edit_ratio=args.max_edit_ratio,
+        hallucinate_evidence=args.hallucinate_evidence,
+        exact_evidence_selection=args.exact_evidence_selection,
+        evidence_scorer=args.evidence_scorer,
+        sentence_splitter=args.sentence_splitter,
+        n_process=args.spacy_n_process,
+        html_extractor=args.html_extractor,
+        passage_prefilter=args.passage_prefilter,
+        speculative_gating=args.speculative_gating,
+    )
+
+    def get_claim_and_context(line: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+        claim = line["input_info"][args.claim_field]
+        if args.context_field:
+            context = line["input_info"][args.context_field]
+            context = " ".join(context.split("\n"))
+        else:
+            context = None
+        return claim, context
+
+    def get_finished_key(line: Dict[str, Any]) -> Optional[str]:
+        if "result" not in line:
+            return None  # Failed claims are run again.
+        return jsonl_io.make_key(line["input_info"][args.claim_field])
+
+    def process_line(line: Dict[str, Any]) -> Dict[str, Any]:
+        claim, context = get_claim_and_context(line)
+        with metrics.collect() as claim_metrics:
+            try:
+                with metrics.track("claim"):
+                    line["result"] = run_editor_one_instance(
+                        claim=claim, context=context, **editor_kwargs
+                    )
+            except CLAIM_ERRORS as exception:
+                line["error"] = make_error_record(exception)
+        line["metrics"] = claim_metrics.to_dict()
+        return line
+
+    async def aprocess_line(line: Dict[str, Any]) -> Dict[str, Any]:
+        claim, context = get_claim_and_context(line)
+        with metrics.collect() as claim_metrics:
+            try:
+                with metrics.track("claim"):
+                    line["result"] = await arun_editor_one_instance(
+                        claim=claim, context=context, **editor_kwargs
+                    )
+            except CLAIM_ERRORS as exception:
+                line["error"] = make_error_record(exception)
+        line["metrics"] = claim_metrics.to_dict()
+        return line
+
+    # Only the compact index is loaded, not the previous output. Failed lines are
+    # dropped from the output, since their claims are run again.
+    resume = args.resume and os.path.exists(args.output_file)
+    finished_keys = set()
+    if resume:
         print(f"Resuming with results from {args.output_file}")
-        finished_results = {
-            l["input_info"][args.claim_field]: l["result"]
-            for l in jsonlines.open(args.output_file)
-        }
-        print(f"Found {len(finished_results)} finished lines.")
+        if not os.path.exists(jsonl_io.get_index_path(args.output_file)):
+            jsonl_io.build_index(args.output_file, get_finished_key)
+        finished_keys = jsonl_io.load_index(args.output_file)
+        print(f"Found {len(finished_keys)} finished lines.")
+
+    if args.work_queue_file:
+        queue = work_queue.WorkQueue(
+            args.work_queue_file, args.input_file, lease_seconds=args.lease_seconds
+        )
+        if args.resume:
+            queue.retry_failed()
+        queue_indices = {}  # Maps the id of each leased line to its queue index.
+        progress = tqdm.tqdm()
     else:
-        finished_results = None
-
-    with open(args.output_file, "w", encoding="utf-8") as writer:
-        lines = list(jsonlines.open(args.input_file))
-        for line in tqdm.tqdm(lines):
-            claim = line["input_info"][args.claim_field]
-            if args.context_field:
-                context = line["input_info"][args.context_field]
-                context = " ".join(context.split("\n"))
-            else:
-                context = None
+        num_lines = jsonl_io.count_lines(args.input_file)
+        progress = tqdm.tqdm(total=num_lines)
+
+    def is_in_shard(line_idx: int, claim_key: str) -> bool:
+        if args.shard_strategy == "range":
+            shard_id = line_idx * args.num_shards // max(num_lines, 1)
+            return min(shard_id, args.num_shards - 1) == args.shard_id
+        return int(claim_key, 16) % args.num_shards == args.shard_id
 
-            # Search for finished result
-            if finished_results and claim in finished_results:
-                line["result"] = finished_results[claim]
+    def read_unfinished_lines() -> Iterator[Dict[str, Any]]:
+        if args.work_queue_file:
+            # Lease claims until the queue is empty.
+            for line_idx, line in iter(queue.lease, None):
+                claim_key = jsonl_io.make_key(line["input_info"][args.claim_field])
+                if claim_key in finished_keys:
+                    queue.complete(line_idx)
+                else:
+                    queue_indices[id(line)] = line_idx
+                    yield line
+            return
+
+        # Stream the input so that memory does not grow with its size.
+        for line_idx, line in enumerate(jsonl_io.read_jsonl(args.input_file)):
+            claim_key = jsonl_io.make_key(line["input_info"][args.claim_field])
+            if claim_key in finished_keys or not is_in_shard(line_idx, claim_key):
+                progress.update()
             else:
-                line["result"] = run_editor_one_instance(
-                    model=args.model,
-                    claim=claim,
-                    context=context,
-                    temperature_qgen=args.temperature_qgen,
-                    num_rounds_qgen=args.num_rounds_qgen,
-                    max_search_results_per_query=args.max_search_results_per_query,
-                    max_sentences_per_passage=args.max_sentences_per_passage,
-                    sliding_distance=args.sliding_distance,
-                    max_passages_per_search_result=args.max_passages_per_search_result,
-                    max_evidences_per_question=args.max_evidences_per_question,
-                    max_edit_ratio=args.max_edit_ratio,
-                    hallucinate_evidence=args.hallucinate_evidence,
+                yield line
+
+    run_summary = metrics.RunSummary()
+    with jsonl_io.JsonlAppender(
+        args.output_file, append=resume, fsync_every=args.fsync_every
+    ) as writer:
+        lines = read_unfinished_lines()
+
+        def write_line(line: Dict[str, Any]) -> None:
+            writer.write(line, key=get_finished_key(line))
+            run_summary.add_claim(line["metrics"])
+            if args.metrics_file and run_summary.num_claims % 100 == 0:
+                run_summary.write_prometheus(args.metrics_file)
+            if args.work_queue_file:
+                queue.complete(queue_indices.pop(id(line)), failed="error" in line)
+            progress.update()
+
+        if args.use_asyncio:
+
+            # Leasing from the work queue and syncing the output block on disk, so
+            # they run in threads to keep the event loop serving in-flight claims.
+            async def read_lines_async() -> AsyncIterator[Dict[str, Any]]:
+                while True:
+                    line = await async_utils.run_in_thread(next, lines, None)
+                    if line is None:
+                        return
+                    yield line
+
+            async def write_lines_async() -> None:
+                results = aordered_map(
+                    aprocess_line,
+                    read_lines_async(),
+                    max_in_flight=args.max_concurrent_claims,
                 )
-            writer.write(json.dumps(line, ensure_ascii=False) + "\n")
+                async for line in results:
+                    await async_utils.run_in_thread(write_line, line)
+
+            async_utils.run(write_lines_async())
+        else:
+            results = ordered_parallel_map(
+                process_line,
+                lines,
+                num_workers=args.num_workers,
+                max_in_flight=args.max_claims_in_flight,
+            )
+            for line in results:
+                write_line(line)
+        progress.close()
+
+    print(f"Stage metrics: {json.dumps(run_summary.summarize(), indent=2)}")
+    if args.metrics_file:
+        run_summary.write_prometheus(args.metrics_file)
+    if args.work_queue_file:
+        print(f"Work queue: {queue.stats()}")
+    if cache.COMPLETION_CACHE is not None:
+        print(f"Completion cache: {cache.COMPLETION_CACHE.stats()}")
+    if cache.SEARCH_CACHE is not None:
+        print(f"Search cache: {cache.SEARCH_CACHE.stats()}")
 
 
 if __name__ == "__main__":
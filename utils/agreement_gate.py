@@ -1,11 +1,7 @@
 """Utils for running the agreement gate."""
-import os
-import time
 from typing import Any, Dict, Tuple
 
-import openai
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from utils import llm
 
 
 def parse_api_response(api_response: str) -> Tuple[bool, str, str]:
@@ -33,6 +29,32 @@ def parse_api_response(api_response: str) -> Tuple[bool, str, str]:
     return is_open, reason, decision
 
 
+def make_completion_kwargs(
+    claim: str,
+    query: str,
+    evidence: str,
+    model: str,
+    prompt: str,
+    context: str = None,
+) -> Dict[str, Any]:
+    """Builds the OpenAI completion request of the agreement gate."""
+    if context:
+        gpt3_input = prompt.format(
+            context=context, claim=claim, query=query, evidence=evidence
+        ).strip()
+    else:
+        gpt3_input = prompt.format(claim=claim, query=query, evidence=evidence).strip()
+
+    return dict(
+        model=model,
+        prompt=gpt3_input,
+        temperature=0.0,
+        max_tokens=256,
+        stop=["\n\n"],
+        logit_bias={"50256": -100},  # Don't allow <|endoftext|> to be generated
+    )
+
+
 def run_agreement_gate(
     claim: str,
     query: str,
@@ -58,28 +80,41 @@ def run_agreement_gate(
     Returns:
         gate: A dictionary with the status of the gate and reasoning for decision.
     """
-    if context:
-        gpt3_input = prompt.format(
-            context=context, claim=claim, query=query, evidence=evidence
-        ).strip()
-    else:
-        gpt3_input = prompt.format(claim=claim, query=query, evidence=evidence).strip()
+    completion_kwargs = make_completion_kwargs(
+        claim=claim,
+        query=query,
+        evidence=evidence,
+        model=model,
+        prompt=prompt,
+        context=context,
+    )
+    response_text = llm.complete(completion_kwargs, num_retries=num_retries)
+
+    is_open, reason, decision = parse_api_response(response_text)
+    gate = {"is_open": is_open, "reason": reason, "decision": decision}
+    return gate
+
+
+async def arun_agreement_gate(
+    claim: str,
+    query: str,
+    evidence: str,
+    model: str,
+    prompt: str,
+    context: str = None,
+    num_retries: int = 5,
+) -> Dict[str, Any]:
+    """Async version of `run_agreement_gate`."""
+    completion_kwargs = make_completion_kwargs(
+        claim=claim,
+        query=query,
+        evidence=evidence,
+        model=model,
+        prompt=prompt,
+        context=context,
+    )
+    response_text = await llm.acomplete(completion_kwargs, num_retries=num_retries)
 
-    for _ in range(num_retries):
-        try:
-            response = openai.Completion.create(
-                model=model,
-                prompt=gpt3_input,
-                temperature=0.0,
-                max_tokens=256,
-                stop=["\n\n"],
-                logit_bias={"50256": -100},  # Don't allow <|endoftext|> to be generated
-            )
-            break
-        except openai.error.OpenAIError as exception:
-            print(f"{exception}. Retrying...")
-            time.sleep(2)
-
-    is_open, reason, decision = parse_api_response(response.choices[0].text)
+    is_open, reason, decision = parse_api_response(response_text)
     gate = {"is_open": is_open, "reason": reason, "decision": decision}
     return gate
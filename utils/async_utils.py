@@ -0,0 +1,140 @@
+"""Utils for running the RARR pipeline with asyncio.
+
+Each backend (OpenAI, Bing, web page scraping) gets its own semaphore so that many
+claims can be in flight in a single event loop without overloading any backend.
+Semaphores and client sessions are bound to the event loop that created them, so
+they are kept per loop. Synchronous callers (e.g., claims run in a thread pool) all
+run their coroutines on one long-lived shared loop, so that sessions, semaphores and
+the default executor are shared by the whole process.
+"""
+import asyncio
+import atexit
+import contextvars
+import functools
+import threading
+import weakref
+from typing import Any, Awaitable, Callable
+
+CONCURRENCY_LIMITS = {"openai": 16, "bing": 8, "scrape": 64}
+
+_SEMAPHORES = weakref.WeakKeyDictionary()
+_LOOP_RESOURCES = weakref.WeakKeyDictionary()
+_SHARED_LOOP = None
+_SHARED_LOOP_THREAD = None
+_SHARED_LOOP_LOCK = threading.Lock()
+CLOSE_TIMEOUT_SECONDS = 10
+
+
+def configure_concurrency(**limits: int) -> None:
+    """Sets the maximum number of concurrent requests to each backend.
+
+    Args:
+        limits: Maximum number of concurrent requests keyed by backend name, i.e.,
+            "openai", "bing" or "scrape".
+    """
+    unknown = set(limits) - set(CONCURRENCY_LIMITS)
+    if unknown:
+        raise ValueError(f"Unknown backends: {sorted(unknown)}")
+    CONCURRENCY_LIMITS.update(limits)
+
+
+def get_semaphore(backend: str) -> asyncio.Semaphore:
+    """Returns the semaphore limiting concurrent requests to a backend."""
+    semaphores = _SEMAPHORES.setdefault(asyncio.get_running_loop(), {})
+    if backend not in semaphores:
+        semaphores[backend] = asyncio.Semaphore(CONCURRENCY_LIMITS[backend])
+    return semaphores[backend]
+
+
+def get_loop_resource(name: str, factory: Callable[[], Any]) -> Any:
+    """Returns a resource (e.g., a client session) shared within the running loop.
+
+    Args:
+        name: Name of the resource.
+        factory: Function creating the resource on first use. If the resource has an
+            async `close` method, it is called by `close_loop_resources`.
+    Returns:
+        resource: The resource of the running loop.
+    """
+    resources = _LOOP_RESOURCES.setdefault(asyncio.get_running_loop(), {})
+    if name not in resources:
+        resources[name] = factory()
+    return resources[name]
+
+
+async def close_loop_resources() -> None:
+    """Closes all resources created in the running loop."""
+    resources = _LOOP_RESOURCES.pop(asyncio.get_running_loop(), {})
+    for resource in resources.values():
+        if hasattr(resource, "close"):
+            await resource.close()
+
+
+async def run_in_thread(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs a blocking (e.g., CPU-bound) function without blocking the event loop.
+
+    Like `asyncio.to_thread`, the function sees the context variables of the caller.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        None, functools.partial(context.run, fn, *args, **kwargs)
+    )
+
+
+def get_shared_loop() -> asyncio.AbstractEventLoop:
+    """Returns the process-wide event loop used by `run`, starting it on first use.
+
+    The loop runs forever in a daemon thread, and its resources are closed when the
+    process exits.
+    """
+    global _SHARED_LOOP, _SHARED_LOOP_THREAD
+    with _SHARED_LOOP_LOCK:
+        if _SHARED_LOOP is None:
+            _SHARED_LOOP = asyncio.new_event_loop()
+            _SHARED_LOOP_THREAD = threading.Thread(
+                target=_SHARED_LOOP.run_forever, name="shared_loop", daemon=True
+            )
+            _SHARED_LOOP_THREAD.start()
+            atexit.register(close_shared_loop)
+    return _SHARED_LOOP
+
+
+def close_shared_loop() -> None:
+    """Closes the resources created in the shared loop and stops it."""
+    global _SHARED_LOOP, _SHARED_LOOP_THREAD
+    with _SHARED_LOOP_LOCK:
+        loop, _SHARED_LOOP = _SHARED_LOOP, None
+        thread, _SHARED_LOOP_THREAD = _SHARED_LOOP_THREAD, None
+    if loop is None:
+        return
+    future = asyncio.run_coroutine_threadsafe(close_loop_resources(), loop)
+    try:
+        future.result(timeout=CLOSE_TIMEOUT_SECONDS)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=CLOSE_TIMEOUT_SECONDS)
+        if not thread.is_alive():
+            loop.close()
+
+
+def run(coroutine: Awaitable[Any]) -> Any:
+    """Runs a coroutine to completion from synchronous code, on the shared loop.
+
+    Works from any thread, whether or not an event loop is already running in it
+    (e.g., in a notebook), but not from within the shared loop itself. The coroutine
+    sees the context variables of the caller.
+
+    Args:
+        coroutine: The coroutine to run.
+    Returns:
+        result: The result of the coroutine.
+    """
+    loop = get_shared_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        raise RuntimeError("Coroutines on the shared loop must be awaited, not run.")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
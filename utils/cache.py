@@ -0,0 +1,218 @@
+"""Utils for persistently caching the results of expensive API calls on disk."""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# A full cache is evicted down to this fraction of its limit, so that the following
+# writes do not each trigger another eviction.
+EVICTION_TARGET_FRACTION = 0.9
+EVICTION_BATCH_SIZE = 1000
+# Other processes may write to the same file, so the total size is recounted now and
+# then rather than on every eviction.
+RECOUNT_SECONDS = 60
+
+
+class DiskCache:
+    """A thread-safe key-value cache stored in a SQLite file.
+
+    Values are stored as JSON. When `max_size_mb` is set, the least recently used
+    entries are evicted once the total size of the stored values exceeds it, down to
+    `EVICTION_TARGET_FRACTION` of it. When
+    `ttl_hours` is set, entries older than it are treated as missing.
+    """
+
+    def __init__(
+        self, path: str, max_size_mb: float = None, ttl_hours: float = None
+    ) -> None:
+        """Opens (or creates) the cache.
+
+        Args:
+            path: Path of the SQLite file backing the cache.
+            max_size_mb: Maximum total size of the cached values in megabytes. If
+                None, entries are never evicted.
+            ttl_hours: Number of hours an entry stays valid after being written. If
+                None, entries never expire.
+        """
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1e6) if max_size_mb else None
+        self.ttl_seconds = ttl_hours * 3600 if ttl_hours else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Multiple workers (threads and processes) may share the same file.
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, "
+                "last_access REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_last_access ON cache(last_access)"
+            )
+            self._recount()
+
+    def _recount(self) -> None:
+        """Recounts the total size of the stored values, including other writers'."""
+        self._total_size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+        self._last_recount = time.monotonic()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the value cached under `key`, or None if there is none."""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, size, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            expired = self.ttl_seconds and row and now - row[2] > self.ttl_seconds
+            if expired:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._total_size -= row[1]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE cache SET last_access = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """Caches `value` under `key`, evicting old entries if the cache is full."""
+        value = json.dumps(value, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT size FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._total_size += size - (row[0] if row else 0)
+            if self.max_size_bytes and self._total_size > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Removes the least recently used entries until the cache is below its target.
+
+        Entries are read in small batches from the `last_access` index, so evicting
+        never scans the whole table.
+        """
+        if time.monotonic() - self._last_recount >= RECOUNT_SECONDS:
+            self._recount()
+        target_size = self.max_size_bytes * EVICTION_TARGET_FRACTION
+        while self._total_size > target_size:
+            rows = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY last_access LIMIT ?",
+                (EVICTION_BATCH_SIZE,),
+            ).fetchall()
+            if not rows:
+                self._total_size = 0  # The count was stale and the cache is empty.
+                break
+            evicted = []
+            for key, size in rows:
+                if self._total_size <= target_size:
+                    break
+                evicted.append((key,))
+                self._total_size -= size
+            self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns hit and miss counters along with the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size_mb": self._total_size / 1e6,
+        }
+
+
+def hash_key(fields: Dict[str, Any]) -> str:
+    """Hashes a JSON-serializable dictionary into a content-addressed cache key."""
+    serialized = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+COMPLETION_CACHE: Optional[DiskCache] = None
+
+
+def enable_completion_cache(path: str, max_size_mb: float = None) -> DiskCache:
+    """Enables caching of OpenAI completions for all RARR modules."""
+    global COMPLETION_CACHE
+    COMPLETION_CACHE = DiskCache(path, max_size_mb=max_size_mb)
+    return COMPLETION_CACHE
+
+
+def completion_key(completion_kwargs: Dict[str, Any], sample_index: int = 0) -> str:
+    """Builds the cache key of a completion request.
+
+    Args:
+        completion_kwargs: Arguments passed to `openai.Completion.create`.
+        sample_index: Index of the sample when the same request is sampled several
+            times with a non-zero temperature. Ignored for greedy decoding.
+    Returns:
+        key: The cache key.
+    """
+    if not completion_kwargs.get("temperature"):
+        sample_index = 0
+    return hash_key({**completion_kwargs, "sample_index": sample_index})
+
+
+def get_completion(
+    completion_kwargs: Dict[str, Any], sample_index: int = 0
+) -> Optional[str]:
+    """Returns the cached completion text of a request, or None if not cached."""
+    if COMPLETION_CACHE is None:
+        return None
+    return COMPLETION_CACHE.get(completion_key(completion_kwargs, sample_index))
+
+
+def set_completion(
+    completion_kwargs: Dict[str, Any], text: str, sample_index: int = 0
+) -> None:
+    """Caches the completion text of a request if the completion cache is enabled."""
+    if COMPLETION_CACHE is not None:
+        COMPLETION_CACHE.set(completion_key(completion_kwargs, sample_index), text)
+
+
+SEARCH_CACHE: Optional[DiskCache] = None
+
+
+def enable_search_cache(
+    path: str, max_size_mb: float = None, ttl_hours: float = None
+) -> DiskCache:
+    """Enables caching of search engine results and scraped web pages."""
+    global SEARCH_CACHE
+    SEARCH_CACHE = DiskCache(path, max_size_mb=max_size_mb, ttl_hours=ttl_hours)
+    return SEARCH_CACHE
+
+
+def get_search(namespace: str, key: str) -> Optional[Any]:
+    """Returns a cached search value (e.g., the URLs of a query), or None if missing.
+
+    Args:
+        namespace: Kind of value cached, e.g., "bing" for search results or "page"
+            for the extracted text of a URL.
+        key: The query or URL the value belongs to.
+    Returns:
+        value: The cached value, or None if it is not cached.
+    """
+    if SEARCH_CACHE is None:
+        return None
+    return SEARCH_CACHE.get(hash_key({"namespace": namespace, "key": key}))
+
+
+def set_search(namespace: str, key: str, value: Any) -> None:
+    """Caches a search value if the search cache is enabled."""
+    if SEARCH_CACHE is not None:
+        SEARCH_CACHE.set(hash_key({"namespace": namespace, "key": key}), value)
@@ -1,11 +1,7 @@
 """Utils for running the editor."""
-import os
-import time
-from typing import Dict, Union
+from typing import Any, Dict
 
-import openai
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from utils import llm
 
 
 def parse_api_response(api_response: str) -> str:
@@ -27,6 +23,41 @@ def parse_api_response(api_response: str) -> str:
     return edited_claim
 
 
+def make_completion_kwargs(
+    claim: str,
+    query: str,
+    evidence: str,
+    model: str,
+    prompt: str,
+    context: str = None,
+) -> Dict[str, Any]:
+    """Builds the OpenAI completion request of the editor."""
+    if context:
+        gpt3_input = prompt.format(
+            context=context, claim=claim, query=query, evidence=evidence
+        ).strip()
+    else:
+        gpt3_input = prompt.format(claim=claim, query=query, evidence=evidence).strip()
+
+    return dict(
+        model=model,
+        prompt=gpt3_input,
+        temperature=0.0,
+        max_tokens=512,
+        stop=["\n\n"],
+    )
+
+
+def make_output(claim: str, response_text: str) -> Dict[str, str]:
+    """Parses the editor response, falling back to the unedited claim on errors."""
+    edited_claim = parse_api_response(response_text)
+    # If there was an error in GPT-3 generation, return the claim.
+    if not edited_claim:
+        edited_claim = claim
+    output = {"text": edited_claim}
+    return output
+
+
 def run_rarr_editor(
     claim: str,
     query: str,
@@ -48,30 +79,35 @@ def run_rarr_editor(
     Returns:
         edited_claim: The edited claim.
     """
-    if context:
-        gpt3_input = prompt.format(
-            context=context, claim=claim, query=query, evidence=evidence
-        ).strip()
-    else:
-        gpt3_input = prompt.format(claim=claim, query=query, evidence=evidence).strip()
+    completion_kwargs = make_completion_kwargs(
+        claim=claim,
+        query=query,
+        evidence=evidence,
+        model=model,
+        prompt=prompt,
+        context=context,
+    )
+    response_text = llm.complete(completion_kwargs, num_retries=num_retries)
+    return make_output(claim, response_text)
 
-    for _ in range(num_retries):
-        try:
-            response = openai.Completion.create(
-                model=model,
-                prompt=gpt3_input,
-                temperature=0.0,
-                max_tokens=512,
-                stop=["\n\n"],
-            )
-            break
-        except openai.error.OpenAIError as exception:
-            print(f"{exception}. Retrying...")
-            time.sleep(2)
 
-    edited_claim = parse_api_response(response.choices[0].text)
-    # If there was an error in GPT-3 generation, return the claim.
-    if not edited_claim:
-        edited_claim = claim
-    output = {"text": edited_claim}
-    return output
+async def arun_rarr_editor(
+    claim: str,
+    query: str,
+    evidence: str,
+    model: str,
+    prompt: str,
+    context: str = None,
+    num_retries: int = 5,
+) -> Dict[str, str]:
+    """Async version of `run_rarr_editor`."""
+    completion_kwargs = make_completion_kwargs(
+        claim=claim,
+        query=query,
+        evidence=evidence,
+        model=model,
+        prompt=prompt,
+        context=context,
+    )
+    response_text = await llm.acomplete(completion_kwargs, num_retries=num_retries)
+    return make_output(claim, response_text)
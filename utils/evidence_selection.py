@@ -1,36 +1,82 @@
+import heapq
 import itertools
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Sequence, Tuple
 
-import torch
-from sentence_transformers import CrossEncoder
+import numpy as np
 
-PASSAGE_RANKER = CrossEncoder(
-    "cross-encoder/ms-marco-MiniLM-L-6-v2",
-    max_length=512,
-    device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-)
+from utils import models, prefilter
+
+EVIDENCE_SCORERS = ("cross_encoder", "bm25")
+
+
+def collect_retrieval_scores(example: Dict[str, Any]) -> Dict[Tuple[str, str], float]:
+    """Collects the (query, evidence) scores already computed during retrieval.
+
+    Args:
+        example: The result of running the editing pipeline on one claim.
+    Returns:
+        known_scores: A mapping from (query, evidence text) to its cross-encoder score.
+    """
+    evidences = [
+        e for evids in example.get("evidences_for_questions", []) for e in evids
+    ] + example["revisions"][0]["evidences"]
+    return {
+        (e["query"], e["text"]): e["retrieval_score"]
+        for e in evidences
+        if "retrieval_score" in e  # Hallucinated evidences are never scored.
+    }
 
 
 def compute_score_matrix(
-    questions: List[str], evidences: List[str]
+    questions: List[str],
+    evidences: List[str],
+    known_scores: Dict[Tuple[str, str], float] = None,
 ) -> List[List[float]]:
     """Scores the relevance of all evidence against all questions using a CrossEncoder.
 
+    Pairs found in `known_scores` are reused and all other pairs are scored in a single
+    batched call.
+
     Args:
         questions: A list of unique questions.
         evidences: A list of unique evidences.
+        known_scores: Already computed scores of (question, evidence) pairs.
     Returns:
         score_matrix: A 2D list list of question X evidence relevance scores.
     """
-    score_matrix = []
-    for q in questions:
-        evidence_scores = PASSAGE_RANKER.predict([(q, e) for e in evidences]).tolist()
-        score_matrix.append(evidence_scores)
+    known_scores = known_scores or {}
+    missing_pairs = [
+        (q, e) for q in questions for e in evidences if (q, e) not in known_scores
+    ]
+    scores = {
+        **known_scores,
+        **dict(zip(missing_pairs, models.score_passages(missing_pairs))),
+    }
+    score_matrix = [[scores[(q, e)] for e in evidences] for q in questions]
     return score_matrix
 
 
+def compute_bm25_score_matrix(
+    questions: List[str], evidences: List[str]
+) -> List[List[float]]:
+    """Scores the relevance of all evidence against all questions with BM25.
+
+    Args:
+        questions: A list of unique questions.
+        evidences: A list of unique evidences.
+    Returns:
+        score_matrix: A 2D list list of question X evidence relevance scores.
+    """
+    evidence_term_counts = prefilter.count_sentence_terms(evidences)
+    evidence_spans = [(idx, idx + 1) for idx in range(len(evidences))]
+    return [
+        prefilter.score_passages_bm25(q, evidence_term_counts, evidence_spans).tolist()
+        for q in questions
+    ]
+
+
 def question_coverage_objective_fn(
-    score_matrix: List[List[float]], evidence_indices: List[int]
+    score_matrix: np.ndarray, evidence_indices: Sequence[int]
 ) -> float:
     """Given (query, evidence) scores and a subset of evidence, return the coverage.
 
@@ -39,7 +85,7 @@ def question_coverage_objective_fn(
     covers (i.e., helps answer) all questions.
 
     Args:
-        score_matrix: A 2D list list of question X evidence relevance scores.
+        score_matrix: A 2D array of question X evidence relevance scores.
         evidence_indicies: A subset of the evidence to to get the coverage score of.
     Returns:
         total: The coverage we would get by using the subset of evidence in
@@ -47,14 +93,86 @@ def question_coverage_objective_fn(
     """
     # Compute sum_{question q} max_{selected evidence e} score(q, e).
     # This encourages all questions to be explained by at least one evidence.
-    total = 0.0
-    for scores_for_question in score_matrix:
-        total += max(scores_for_question[j] for j in evidence_indices)
-    return total
+    score_matrix = np.asarray(score_matrix, dtype=float)
+    return float(score_matrix[:, list(evidence_indices)].max(axis=1).sum())
+
+
+def exact_select(
+    score_matrix: np.ndarray, max_selected: int, prefer_fewer: bool = False
+) -> List[int]:
+    """Finds the subset of evidence maximizing the coverage by trying all subsets.
+
+    The number of subsets grows exponentially with the number of evidences, so this
+    should only be used on small inputs.
+
+    Args:
+        score_matrix: A 2D array of question X evidence relevance scores.
+        max_selected: Maximum number of evidences to select.
+        prefer_fewer: If True, also consider subsets smaller than `max_selected`.
+    Returns:
+        selected_indices: Indices of the selected evidences.
+    """
+    num_evidences = score_matrix.shape[1]
+    best_combo = tuple()
+    best_objective_value = float("-inf")
+    min_selected = 1 if prefer_fewer else max_selected
+    for num_selected in range(min_selected, max_selected + 1):
+        for combo in itertools.combinations(range(num_evidences), num_selected):
+            objective_value = question_coverage_objective_fn(score_matrix, combo)
+            if objective_value > best_objective_value:
+                best_combo = combo
+                best_objective_value = objective_value
+    return list(best_combo)
+
+
+def lazy_greedy_select(
+    score_matrix: np.ndarray, max_selected: int, prefer_fewer: bool = False
+) -> List[int]:
+    """Approximately maximizes the coverage with lazy greedy selection.
+
+    The coverage objective is monotone submodular, so greedily adding the evidence
+    with the largest marginal gain is within a factor of (1 - 1/e) of the optimum.
+    Marginal gains only shrink as evidences are added, so stale gains kept in a
+    priority queue are upper bounds and only the top of the queue is re-evaluated.
+
+    Args:
+        score_matrix: A 2D array of question X evidence relevance scores.
+        max_selected: Maximum number of evidences to select.
+        prefer_fewer: If True, stop once no evidence improves the coverage.
+    Returns:
+        selected_indices: Indices of the selected evidences.
+    """
+    if not score_matrix.shape[0]:
+        return list(range(max_selected))
+
+    # The first evidence is the one with the best total score over all questions.
+    first = int(np.argmax(score_matrix.sum(axis=0)))
+    selected = [first]
+    coverage = score_matrix[:, first].copy()
+    gains = np.maximum(score_matrix - coverage[:, None], 0).sum(axis=0)
+    heap = [(-gain, idx) for idx, gain in enumerate(gains.tolist()) if idx != first]
+    heapq.heapify(heap)
+
+    while heap and len(selected) < max_selected:
+        _, idx = heapq.heappop(heap)
+        gain = float(np.maximum(score_matrix[:, idx] - coverage, 0).sum())
+        if heap and gain < -heap[0][0]:
+            # The gain is stale and another evidence may be better, so re-queue it.
+            heapq.heappush(heap, (-gain, idx))
+            continue
+        if prefer_fewer and gain <= 0:
+            break
+        selected.append(idx)
+        coverage = np.maximum(coverage, score_matrix[:, idx])
+    return sorted(selected)
 
 
 def select_evidences(
-    example: Dict[str, Any], max_selected: int = 5, prefer_fewer: bool = False
+    example: Dict[str, Any],
+    max_selected: int = 5,
+    prefer_fewer: bool = False,
+    exact: bool = False,
+    scorer: str = "cross_encoder",
 ) -> List[Dict[str, Any]]:
     """Selects the set of evidence that maximizes information converage over the claim.
 
@@ -63,6 +181,11 @@ def select_evidences(
         max_selected: Maximum number of evidences to select.
         prefer_fewer: If True and the maximum objective value can be achieved by
             fewer evidences than `max_selected`, prefer selecting fewer evidences.
+        exact: If True, search all subsets of evidence for the best one instead of
+            selecting evidences greedily. Exponential in the number of evidences.
+        scorer: How to score the (question, evidence) pairs. "cross_encoder" reuses
+            the retrieval scores and scores the other pairs with the passage ranker,
+            while "bm25" scores all pairs lexically without loading any model.
     Returns:
         selected_evidences: Selected evidences that serve as the attribution report.
     """
@@ -72,18 +195,21 @@ def select_evidences(
     if not num_evidences:
         return []
 
-    score_matrix = compute_score_matrix(questions, evidences)
+    if scorer == "bm25":
+        score_matrix = compute_bm25_score_matrix(questions, evidences)
+    elif scorer == "cross_encoder":
+        score_matrix = compute_score_matrix(
+            questions, evidences, known_scores=collect_retrieval_scores(example)
+        )
+    else:
+        raise ValueError(f"Unknown evidence scorer: {scorer}")
+    score_matrix = np.asarray(score_matrix, dtype=float).reshape(
+        len(questions), num_evidences
+    )
 
-    best_combo = tuple()
-    best_objective_value = float("-inf")
     max_selected = min(max_selected, num_evidences)
-    min_selected = 1 if prefer_fewer else max_selected
-    for num_selected in range(min_selected, max_selected + 1):
-        for combo in itertools.combinations(range(num_evidences), num_selected):
-            objective_value = question_coverage_objective_fn(score_matrix, combo)
-            if objective_value > best_objective_value:
-                best_combo = combo
-                best_objective_value = objective_value
+    select_fn = exact_select if exact else lazy_greedy_select
+    selected_indices = select_fn(score_matrix, max_selected, prefer_fewer=prefer_fewer)
 
-    selected_evidences = [{"text": evidences[idx]} for idx in best_combo]
+    selected_evidences = [{"text": evidences[idx]} for idx in selected_indices]
     return selected_evidences
@@ -1,11 +1,19 @@
 """Utils for generating fake evidence given a query."""
-import os
-import time
-from typing import Dict
+from typing import Any, Dict
 
-import openai
+from utils import llm
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+
+def make_completion_kwargs(query: str, model: str, prompt: str) -> Dict[str, Any]:
+    """Builds the OpenAI completion request for hallucinating evidence."""
+    gpt3_input = prompt.format(query=query).strip()
+    return dict(
+        model=model,
+        prompt=gpt3_input,
+        temperature=0.0,
+        max_tokens=256,
+        stop=["\n", "\n\n"],
+    )
 
 
 def run_evidence_hallucination(
@@ -24,21 +32,24 @@ def run_evidence_hallucination(
     Returns:
         output: A potentially inaccurate piece of evidence.
     """
-    gpt3_input = prompt.format(query=query).strip()
-    for _ in range(num_retries):
-        try:
-            response = openai.Completion.create(
-                model=model,
-                prompt=gpt3_input,
-                temperature=0.0,
-                max_tokens=256,
-                stop=["\n", "\n\n"],
-            )
-            break
-        except openai.error.OpenAIError as exception:
-            print(f"{exception}. Retrying...")
-            time.sleep(2)
-
-    hallucinated_evidence = response.choices[0].text.strip()
+    completion_kwargs = make_completion_kwargs(query, model, prompt)
+    response_text = llm.complete(completion_kwargs, num_retries=num_retries)
+
+    hallucinated_evidence = response_text.strip()
+    output = {"text": hallucinated_evidence, "query": query}
+    return output
+
+
+async def arun_evidence_hallucination(
+    query: str,
+    model: str,
+    prompt: str,
+    num_retries: int = 5,
+) -> Dict[str, str]:
+    """Async version of `run_evidence_hallucination`."""
+    completion_kwargs = make_completion_kwargs(query, model, prompt)
+    response_text = await llm.acomplete(completion_kwargs, num_retries=num_retries)
+
+    hallucinated_evidence = response_text.strip()
     output = {"text": hallucinated_evidence, "query": query}
     return output
@@ -0,0 +1,253 @@
+"""Utils for streaming JSON lines in and out of large files in constant memory.
+
+Outputs are appended to. Next to each output file, an index file records the size of
+the output file once each line was written, along with a compact key if the line is
+finished, so that resuming only needs to read the index. On resume, the output is
+truncated to the end of the last indexed line, which drops any line that was only
+partially written when the previous run was interrupted, and the unfinished lines
+(e.g., failed claims) are dropped so that running them again does not duplicate them.
+"""
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+
+def read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """Yields the JSON object of each non-empty line of a file, one at a time."""
+    with open(path, encoding="utf-8") as reader:
+        for line in reader:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_lines(path: str) -> int:
+    """Counts the lines `read_jsonl` yields, without parsing or holding them in memory.
+
+    Empty lines are skipped and a last line without a trailing newline is counted, so
+    that the count matches the indices of the lines read.
+    """
+    with open(path, encoding="utf-8") as reader:
+        return sum(1 for line in reader if line.strip())
+
+
+def make_key(text: str) -> str:
+    """Returns a compact, fixed-size key identifying a line (e.g., by its claim)."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_index_path(path: str) -> str:
+    """Returns the path of the index file of an output file."""
+    return path + "_index"
+
+
+def build_index(path: str, key_fn: Callable[[Dict[str, Any]], Optional[str]]) -> None:
+    """Writes the index of an existing output file that has none.
+
+    Args:
+        path: Path of the output file.
+        key_fn: Function returning the key of a finished output line, or None if the
+            line is not finished (e.g., the claim failed).
+    """
+    offset = 0
+    with open(path, "rb") as reader, open(
+        get_index_path(path), "w", encoding="utf-8"
+    ) as index_writer:
+        for raw_line in reader:
+            if not raw_line.endswith(b"\n"):
+                break  # The last line was only partially written.
+            offset += len(raw_line)
+            if not raw_line.strip():
+                continue
+            key = key_fn(json.loads(raw_line))
+            index_writer.write(f"{key or ''}\t{offset}\n")
+
+
+def read_index(path: str) -> Iterator[Tuple[str, int, int]]:
+    """Yields the valid entries of the index of an output file, in order.
+
+    Entries pointing past the end of the output (whose lines were lost in a crash) and
+    everything after them are ignored.
+
+    Args:
+        path: Path of the output file.
+    Yields:
+        key: Key of the line, or "" if the line is not finished.
+        end_offset: Size of the output file once the line was written.
+        index_size: Size of the index file up to the entry.
+    """
+    output_size = os.path.getsize(path)
+    index_size = 0
+    with open(get_index_path(path), "rb") as index_reader:
+        for entry in index_reader:
+            key, _, offset = entry.decode("utf-8").rstrip("\n").partition("\t")
+            if not entry.endswith(b"\n") or not offset.isdigit():
+                return  # The last entry was only partially written.
+            if int(offset) > output_size:
+                return
+            index_size += len(entry)
+            yield key, int(offset), index_size
+
+
+def drop_unfinished_lines(path: str) -> None:
+    """Rewrites an output file and its index with only their finished lines.
+
+    Args:
+        path: Path of the output file, whose index holds an entry for every line.
+    """
+    tmp_path = path + ".tmp"
+    new_offset = 0
+    with open(path, "rb") as reader, open(tmp_path, "wb") as writer, open(
+        get_index_path(tmp_path), "w", encoding="utf-8"
+    ) as index_writer:
+        for key, end_offset, _ in read_index(path):
+            raw_line = reader.read(end_offset - reader.tell())
+            if key:
+                writer.write(raw_line)
+                new_offset += len(raw_line)
+                index_writer.write(f"{key}\t{new_offset}\n")
+    os.replace(get_index_path(tmp_path), get_index_path(path))
+    os.replace(tmp_path, path)
+
+
+def load_index(path: str) -> Set[str]:
+    """Reads the keys of the finished lines of an output file.
+
+    The output file is truncated to the end of its last indexed line, and its
+    unfinished lines are dropped, so that appending starts clean.
+
+    Args:
+        path: Path of the output file.
+    Returns:
+        finished_keys: The keys of the finished lines.
+    """
+    finished_keys = set()
+    num_unfinished = 0
+    end_offset = 0
+    index_size = 0
+    for key, end_offset, index_size in read_index(path):
+        if key:
+            finished_keys.add(key)
+        else:
+            num_unfinished += 1
+
+    # Drop what was written after the last indexed line.
+    with open(path, "r+b") as writer:
+        writer.truncate(end_offset)
+    with open(get_index_path(path), "r+b") as index_writer:
+        index_writer.truncate(index_size)
+    if num_unfinished:
+        drop_unfinished_lines(path)
+    return finished_keys
+
+
+class JsonlAppender:
+    """Appends JSON lines to an output file and the keys of finished ones to its index.
+
+    Writes are flushed to the operating system after every line and synced to disk
+    every `fsync_every` lines, so a crash loses at most the last few lines.
+    """
+
+    def __init__(self, path: str, append: bool = False, fsync_every: int = 100) -> None:
+        """Opens the output file and its index.
+
+        Args:
+            path: Path of the output file.
+            append: Whether to append to the existing output file and index instead of
+                overwriting them.
+            fsync_every: Number of lines written between syncs to disk.
+        """
+        mode = "a" if append else "w"
+        self.fsync_every = fsync_every
+        self.num_unsynced = 0
+        self._writer = open(path, mode + "b")
+        self._index_writer = open(get_index_path(path), mode, encoding="utf-8")
+
+    def write(self, line: Dict[str, Any], key: str = None) -> None:
+        """Appends a line and indexes it, under `key` if it is finished.
+
+        Args:
+            line: The JSON object to write.
+            key: Key of the line if it is finished, or None if it should be dropped
+                and run again when resuming.
+        """
+        serialized = json.dumps(line, ensure_ascii=False) + "\n"
+        self._writer.write(serialized.encode("utf-8"))
+        self._writer.flush()
+        self._index_writer.write(f"{key or ''}\t{self._writer.tell()}\n")
+        self._index_writer.flush()
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        """Syncs the output file, then its index, to disk."""
+        os.fsync(self._writer.fileno())
+        os.fsync(self._index_writer.fileno())
+        self.num_unsynced = 0
+
+    def close(self) -> None:
+        """Syncs and closes the output file and its index."""
+        self.sync()
+        self._writer.close()
+        self._index_writer.close()
+
+    def __enter__(self) -> "JsonlAppender":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def merge_outputs(
+    input_path: str,
+    output_paths: List[str],
+    merged_path: str,
+    key_fn: Callable[[Dict[str, Any]], str],
+) -> Tuple[int, int]:
+    """Merges the outputs of several workers into a single file in input order.
+
+    Only the position of each output line is held in memory. If a line was written
+    several times (e.g., it failed and was run again), a finished line is preferred.
+
+    Args:
+        input_path: Path of the input file the outputs were computed from.
+        output_paths: Paths of the output files of the workers.
+        merged_path: Path of the merged output file.
+        key_fn: Function returning the key of an input or output line.
+    Returns:
+        num_merged: Number of input lines written to the merged file.
+        num_missing: Number of input lines not found in any output file.
+    """
+    locations = {}
+    for path_idx, path in enumerate(output_paths):
+        offset = 0
+        with open(path, "rb") as reader:
+            for raw_line in reader:
+                if not raw_line.endswith(b"\n"):
+                    break  # The last line was only partially written.
+                if raw_line.strip():
+                    line = json.loads(raw_line)
+                    key = key_fn(line)
+                    finished = "result" in line
+                    if finished or not locations.get(key, (0, 0, False))[2]:
+                        locations[key] = (path_idx, offset, finished)
+                offset += len(raw_line)
+
+    num_merged, num_missing = 0, 0
+    readers = [open(path, "rb") for path in output_paths]
+    try:
+        with open(merged_path, "wb") as writer:
+            for line in read_jsonl(input_path):
+                location = locations.get(key_fn(line))
+                if location is None:
+                    num_missing += 1
+                    continue
+                reader = readers[location[0]]
+                reader.seek(location[1])
+                writer.write(reader.readline())
+                num_merged += 1
+    finally:
+        for reader in readers:
+            reader.close()
+    return num_merged, num_missing
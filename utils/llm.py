@@ -0,0 +1,382 @@
+"""Utils for calling the OpenAI completions API with caching and retries.
+
+All completion calls share one rate limiter with a requests-per-minute and a
+tokens-per-minute bucket, so that concurrent claims stay within the API quota instead
+of failing and retrying in lockstep. Failed calls are retried with exponential backoff
+and jitter, honoring the Retry-After header when the API sends one.
+"""
+import asyncio
+import concurrent.futures
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+import aiohttp
+import openai
+
+from utils import async_utils, cache, metrics
+
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+MAX_BACKOFF_SECONDS = 60
+# Mentions of the `n` parameter (e.g., "n must be 1") in error messages.
+N_PARAM_REGEX = re.compile(r"(?<![\w.-])['\"`]?n['\"`]?(?![\w-])")
+
+
+class RateLimiter:
+    """Thread-safe token buckets limiting requests and tokens per minute.
+
+    Each call reserves its cost up front and is told how long to wait before sending.
+    Reservations may drive a bucket negative, which makes later callers wait longer,
+    so waiting callers are served in the order they arrived.
+    """
+
+    def __init__(
+        self, requests_per_minute: float = None, tokens_per_minute: float = None
+    ) -> None:
+        """Creates the buckets. A None limit disables the corresponding bucket."""
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.levels = {name: limit for name, limit in self.limits.items() if limit}
+        self.last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, num_tokens: int) -> float:
+        """Reserves one request of `num_tokens` tokens.
+
+        Args:
+            num_tokens: Number of tokens the request is expected to use.
+        Returns:
+            wait_seconds: Number of seconds to wait before sending the request.
+        """
+        costs = {"requests": 1, "tokens": num_tokens}
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.last_update
+            self.last_update = now
+            wait_seconds = 0.0
+            for name, level in self.levels.items():
+                per_second = self.limits[name] / 60
+                # Refill the bucket, but never above its capacity of one minute.
+                level = min(level + elapsed * per_second, self.limits[name])
+                level -= min(costs[name], self.limits[name])
+                self.levels[name] = level
+                if level < 0:
+                    wait_seconds = max(wait_seconds, -level / per_second)
+        return wait_seconds
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def configure_rate_limits(
+    requests_per_minute: float = None, tokens_per_minute: float = None
+) -> None:
+    """Sets the rate limits shared by all OpenAI completion calls."""
+    global RATE_LIMITER
+    RATE_LIMITER = RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+def estimate_num_tokens(completion_kwargs: Dict[str, Any]) -> int:
+    """Estimates the tokens a request counts against the tokens-per-minute limit.
+
+    The API counts the prompt and `max_tokens` for every sampled completion. Prompt
+    tokens are approximated as 4 characters per token.
+    """
+    prompt_tokens = len(completion_kwargs["prompt"]) // 4
+    completion_tokens = completion_kwargs.get("max_tokens", 16)
+    return prompt_tokens + completion_tokens * completion_kwargs.get("n", 1)
+
+
+def get_backoff_seconds(
+    exception: openai.error.OpenAIError, retry_idx: int, retry_sleep: float
+) -> float:
+    """Returns how long to wait before retrying a failed call.
+
+    Args:
+        exception: The error of the failed call.
+        retry_idx: Number of retries already done.
+        retry_sleep: Base number of seconds to wait, doubled after every retry.
+    Returns:
+        backoff_seconds: Number of seconds to wait.
+    """
+    backoff_seconds = min(retry_sleep * 2**retry_idx, MAX_BACKOFF_SECONDS)
+    # Jitter keeps concurrent callers that failed together from retrying together.
+    backoff_seconds = random.uniform(backoff_seconds / 2, backoff_seconds)
+    retry_after = get_retry_after(exception)
+    if retry_after is not None:
+        backoff_seconds = max(backoff_seconds, retry_after)
+    return backoff_seconds
+
+
+def get_retry_after(exception: openai.error.OpenAIError) -> Optional[float]:
+    """Returns the Retry-After header of an API error in seconds, if any."""
+    headers = getattr(exception, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError) as _:
+        return None
+
+
+def record_usage(response: Any) -> None:
+    """Adds the tokens billed for a response to the metrics of the current stage."""
+    usage = getattr(response, "usage", None)
+    metrics.add(
+        api_calls=1,
+        prompt_tokens=getattr(usage, "prompt_tokens", 0),
+        completion_tokens=getattr(usage, "completion_tokens", 0),
+    )
+
+
+def create_completion(
+    completion_kwargs: Dict[str, Any], num_retries: int = 5, retry_sleep: float = 2
+) -> Any:
+    """Calls `openai.Completion.create` within the rate limits, retrying on failure.
+
+    Args:
+        completion_kwargs: Arguments passed to `openai.Completion.create`.
+        num_retries: Number of times to retry OpenAI call in the event of an API failure.
+        retry_sleep: Number of seconds to wait before the first retry.
+    Returns:
+        response: The API response.
+    Raises:
+        openai.error.OpenAIError: If the request is invalid or all retries failed.
+    """
+    num_tokens = estimate_num_tokens(completion_kwargs)
+    for retry_idx in range(num_retries):
+        time.sleep(RATE_LIMITER.reserve(num_tokens))
+        try:
+            response = openai.Completion.create(**completion_kwargs)
+            record_usage(response)
+            return response
+        except openai.error.InvalidRequestError as _:
+            raise  # Retrying a malformed or unsupported request cannot help.
+        except openai.error.OpenAIError as exception:
+            print(f"{exception}. Retrying...")
+            metrics.add(api_errors=1)
+            if retry_idx == num_retries - 1:
+                raise
+            time.sleep(get_backoff_seconds(exception, retry_idx, retry_sleep))
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """Returns the HTTP session shared by all async OpenAI calls of the running loop.
+
+    Without it, `openai.Completion.acreate` opens a new session, and so a new
+    connection, for every request.
+    """
+    return async_utils.get_loop_resource("openai_session", aiohttp.ClientSession)
+
+
+async def acreate_completion(
+    completion_kwargs: Dict[str, Any], num_retries: int = 5, retry_sleep: float = 2
+) -> Any:
+    """Async version of `create_completion`, limited by the "openai" semaphore."""
+    openai.aiosession.set(get_aiohttp_session())
+    num_tokens = estimate_num_tokens(completion_kwargs)
+    for retry_idx in range(num_retries):
+        await asyncio.sleep(RATE_LIMITER.reserve(num_tokens))
+        try:
+            async with async_utils.get_semaphore("openai"):
+                response = await openai.Completion.acreate(**completion_kwargs)
+            record_usage(response)
+            return response
+        except openai.error.InvalidRequestError as _:
+            raise  # Retrying a malformed or unsupported request cannot help.
+        except openai.error.OpenAIError as exception:
+            print(f"{exception}. Retrying...")
+            metrics.add(api_errors=1)
+            if retry_idx == num_retries - 1:
+                raise
+            await asyncio.sleep(get_backoff_seconds(exception, retry_idx, retry_sleep))
+
+
+def complete(
+    completion_kwargs: Dict[str, Any],
+    num_retries: int = 5,
+    retry_sleep: float = 2,
+    sample_index: int = 0,
+) -> str:
+    """Gets the text of a completion, from the completion cache if possible.
+
+    Args:
+        completion_kwargs: Arguments passed to `openai.Completion.create`.
+        num_retries: Number of times to retry OpenAI call in the event of an API failure.
+        retry_sleep: Number of seconds to wait before the first retry.
+        sample_index: Index of the sample when the same request is sampled several
+            times with a non-zero temperature.
+    Returns:
+        text: The text of the first completion choice.
+    Raises:
+        openai.error.OpenAIError: If all retries failed.
+    """
+    text = cache.get_completion(completion_kwargs, sample_index=sample_index)
+    if text is not None:
+        metrics.add(cache_hits=1)
+        return text
+
+    response = create_completion(completion_kwargs, num_retries, retry_sleep)
+    text = response.choices[0].text
+    cache.set_completion(completion_kwargs, text, sample_index=sample_index)
+    return text
+
+
+async def acomplete(
+    completion_kwargs: Dict[str, Any],
+    num_retries: int = 5,
+    retry_sleep: float = 2,
+    sample_index: int = 0,
+) -> str:
+    """Async version of `complete`, limited by the "openai" concurrency semaphore."""
+    text = cache.get_completion(completion_kwargs, sample_index=sample_index)
+    if text is not None:
+        metrics.add(cache_hits=1)
+        return text
+
+    response = await acreate_completion(completion_kwargs, num_retries, retry_sleep)
+    text = response.choices[0].text
+    cache.set_completion(completion_kwargs, text, sample_index=sample_index)
+    return text
+
+
+def get_cached_samples(
+    completion_kwargs: Dict[str, Any], num_samples: int
+) -> List[Optional[str]]:
+    """Returns the cached text of each sample of a request, None for missing ones.
+
+    With greedy decoding all samples are identical, so only the first one is looked up
+    and it stands in for all of them.
+    """
+    if not completion_kwargs.get("temperature"):
+        texts = [cache.get_completion(completion_kwargs)] * num_samples
+    else:
+        texts = [
+            cache.get_completion(completion_kwargs, sample_index=sample_index)
+            for sample_index in range(num_samples)
+        ]
+    metrics.add(cache_hits=sum(text is not None for text in texts))
+    return texts
+
+
+def get_missing_samples(
+    completion_kwargs: Dict[str, Any], texts: List[Optional[str]]
+) -> List[int]:
+    """Returns the indices of the samples that still have to be requested."""
+    missing = [sample_index for sample_index, text in enumerate(texts) if text is None]
+    if not completion_kwargs.get("temperature"):
+        return missing[:1]
+    return missing
+
+
+def fill_samples(
+    completion_kwargs: Dict[str, Any],
+    texts: List[Union[str, BaseException, None]],
+    missing: List[int],
+    sampled_texts: List[Union[str, BaseException]],
+) -> List[Union[str, BaseException]]:
+    """Caches the newly sampled texts and puts them at their sample indices."""
+    for sample_index, text in zip(missing, sampled_texts):
+        if not isinstance(text, BaseException):
+            cache.set_completion(completion_kwargs, text, sample_index=sample_index)
+        texts[sample_index] = text
+    if not completion_kwargs.get("temperature"):
+        texts = [texts[0]] * len(texts)
+    return texts
+
+
+def is_n_unsupported(exception: openai.error.InvalidRequestError) -> bool:
+    """Determines whether a request was rejected because its `n` is unsupported."""
+    return exception.param == "n" or N_PARAM_REGEX.search(str(exception)) is not None
+
+
+def complete_samples(
+    completion_kwargs: Dict[str, Any],
+    num_samples: int,
+    num_retries: int = 5,
+    retry_sleep: float = 2,
+) -> List[Union[str, openai.error.OpenAIError]]:
+    """Samples several completions of the same request, from the cache if possible.
+
+    The missing samples are requested in a single API call with the `n` parameter, so
+    the prompt is only sent (and billed) once. If the backend rejects `n`, they are
+    requested with concurrent single-sample calls instead, while other invalid requests
+    (e.g., a prompt that is too long) are raised. Each sample is cached under its own
+    sample index, like the samples of `complete`.
+
+    Args:
+        completion_kwargs: Arguments passed to `openai.Completion.create`.
+        num_samples: Number of completions to sample.
+        num_retries: Number of times to retry OpenAI call in the event of an API failure.
+        retry_sleep: Number of seconds to wait before the first retry.
+    Returns:
+        texts: The text of each sample, or the error it failed with.
+    """
+    texts = get_cached_samples(completion_kwargs, num_samples)
+    missing = get_missing_samples(completion_kwargs, texts)
+    if not missing:
+        return texts
+
+    try:
+        response = create_completion(
+            {**completion_kwargs, "n": len(missing)}, num_retries, retry_sleep
+        )
+        sampled_texts = [choice.text for choice in response.choices]
+    except openai.error.InvalidRequestError as exception:
+        if not is_n_unsupported(exception):
+            raise  # E.g., the prompt is too long, which single samples cannot fix.
+        # The backend does not support `n`, so sample one completion per call.
+        with concurrent.futures.ThreadPoolExecutor(len(missing)) as executor:
+            futures = [
+                executor.submit(
+                    complete,
+                    completion_kwargs,
+                    num_retries=num_retries,
+                    retry_sleep=retry_sleep,
+                    sample_index=sample_index,
+                )
+                for sample_index in missing
+            ]
+        sampled_texts = [future.exception() or future.result() for future in futures]
+    except openai.error.OpenAIError as exception:
+        sampled_texts = [exception] * len(missing)
+    return fill_samples(completion_kwargs, texts, missing, sampled_texts)
+
+
+async def acomplete_samples(
+    completion_kwargs: Dict[str, Any],
+    num_samples: int,
+    num_retries: int = 5,
+    retry_sleep: float = 2,
+) -> List[Union[str, openai.error.OpenAIError]]:
+    """Async version of `complete_samples`."""
+    texts = get_cached_samples(completion_kwargs, num_samples)
+    missing = get_missing_samples(completion_kwargs, texts)
+    if not missing:
+        return texts
+
+    try:
+        response = await acreate_completion(
+            {**completion_kwargs, "n": len(missing)}, num_retries, retry_sleep
+        )
+        sampled_texts = [choice.text for choice in response.choices]
+    except openai.error.InvalidRequestError as exception:
+        if not is_n_unsupported(exception):
+            raise  # E.g., the prompt is too long, which single samples cannot fix.
+        # The backend does not support `n`, so sample one completion per call.
+        sampled_texts = await asyncio.gather(
+            *(
+                acomplete(
+                    completion_kwargs,
+                    num_retries=num_retries,
+                    retry_sleep=retry_sleep,
+                    sample_index=sample_index,
+                )
+                for sample_index in missing
+            ),
+            return_exceptions=True,
+        )
+    except openai.error.OpenAIError as exception:
+        sampled_texts = [exception] * len(missing)
+    return fill_samples(completion_kwargs, texts, missing, sampled_texts)
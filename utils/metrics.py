@@ -0,0 +1,194 @@
+"""Utils for measuring where the time of the RARR pipeline goes.
+
+Each claim collects the wall time, number of calls, bytes downloaded and tokens used
+of every stage into a `Metrics` object, which is found through a context variable so
+that it follows the claim across coroutines and worker threads. The metrics of all
+claims are aggregated into a `RunSummary`, which reports percentiles of the time spent
+in each stage and can be exported in the Prometheus text format.
+"""
+import collections
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+CURRENT_METRICS = contextvars.ContextVar("current_metrics", default=None)
+CURRENT_STAGE = contextvars.ContextVar("current_stage", default=None)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Histogram buckets grow by 2^(1/8) (about 9%) from 1ms, bounding the relative error
+# of the percentiles while using constant memory for any number of claims.
+BUCKET_GROWTH = 2 ** (1 / 8)
+MIN_BUCKET_SECONDS = 1e-3
+
+
+class Metrics:
+    """Thread-safe counters (e.g., seconds, calls, bytes) of each stage of a claim."""
+
+    def __init__(self) -> None:
+        self.stages = collections.defaultdict(lambda: collections.defaultdict(float))
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, **counters: float) -> None:
+        """Adds to the counters of a stage."""
+        with self._lock:
+            for name, value in counters.items():
+                self.stages[stage][name] += value
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        """Returns the counters of each stage, e.g., to write in the output record."""
+        with self._lock:
+            return {
+                stage: {name: round(value, 6) for name, value in counters.items()}
+                for stage, counters in self.stages.items()
+            }
+
+
+@contextlib.contextmanager
+def collect() -> Iterator[Metrics]:
+    """Collects the metrics of everything run within the block (e.g., one claim)."""
+    metrics = Metrics()
+    token = CURRENT_METRICS.set(metrics)
+    try:
+        yield metrics
+    finally:
+        CURRENT_METRICS.reset(token)
+
+
+@contextlib.contextmanager
+def track(stage: str, calls: int = 1) -> Iterator[None]:
+    """Records the wall time and number of calls of a stage.
+
+    Counters added with `add` within the block without a stage are attributed to it.
+
+    Args:
+        stage: Name of the stage.
+        calls: Number of calls the block makes, e.g., when they run concurrently.
+    """
+    token = CURRENT_STAGE.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CURRENT_STAGE.reset(token)
+        add(stage, seconds=time.perf_counter() - start, calls=calls)
+
+
+def add(stage: Optional[str] = None, **counters: float) -> None:
+    """Adds to the counters of a stage of the current claim, if metrics are collected.
+
+    Args:
+        stage: Name of the stage. If None, the innermost tracked stage is used.
+        counters: Values to add, e.g., `num_bytes` or `prompt_tokens`.
+    """
+    metrics = CURRENT_METRICS.get()
+    stage = stage or CURRENT_STAGE.get()
+    if metrics is not None and stage is not None:
+        metrics.add(stage, **counters)
+
+
+class RunSummary:
+    """Aggregates the metrics of all claims of a run in constant memory."""
+
+    def __init__(self) -> None:
+        self.start = time.time()
+        self.num_claims = 0
+        self.totals = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.histograms = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def add_claim(self, claim_metrics: Dict[str, Dict[str, float]]) -> None:
+        """Adds the metrics of a finished claim, as returned by `Metrics.to_dict`."""
+        with self._lock:
+            self.num_claims += 1
+            for stage, counters in claim_metrics.items():
+                for name, value in counters.items():
+                    self.totals[stage][name] += value
+                seconds = max(counters.get("seconds", 0.0), MIN_BUCKET_SECONDS)
+                bucket = math.log(seconds / MIN_BUCKET_SECONDS, BUCKET_GROWTH)
+                self.histograms[stage][math.ceil(bucket)] += 1
+
+    def get_quantile(self, stage: str, quantile: float) -> float:
+        """Estimates a quantile of the seconds spent in a stage per claim."""
+        histogram = self.histograms[stage]
+        rank = quantile * sum(histogram.values())
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= rank:
+                return MIN_BUCKET_SECONDS * BUCKET_GROWTH**bucket
+        return 0.0
+
+    def summarize(self) -> Dict[str, Any]:
+        """Returns the throughput of the run and the percentiles and totals per stage.
+
+        Returns:
+            summary: The number of claims and claims per second, along with, for each
+                stage, the p50/p95/p99 seconds per claim and the totals of its counters.
+        """
+        with self._lock:
+            elapsed = time.time() - self.start
+            stages = {
+                stage: {
+                    **{
+                        f"p{round(quantile * 100)}_seconds": round(
+                            self.get_quantile(stage, quantile), 6
+                        )
+                        for quantile in QUANTILES
+                    },
+                    **{f"total_{name}": round(v, 6) for name, v in totals.items()},
+                }
+                for stage, totals in self.totals.items()
+            }
+            return {
+                "num_claims": self.num_claims,
+                "claims_per_second": self.num_claims / elapsed if elapsed else 0.0,
+                "stages": stages,
+            }
+
+    def to_prometheus(self, prefix: str = "rarr") -> str:
+        """Formats the summary in the Prometheus text exposition format."""
+        summary = self.summarize()
+        lines = [
+            f"# TYPE {prefix}_claims_total counter",
+            f"{prefix}_claims_total {summary['num_claims']}",
+            f"# TYPE {prefix}_claims_per_second gauge",
+            f"{prefix}_claims_per_second {summary['claims_per_second']}",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in summary["stages"].items():
+            for quantile in QUANTILES:
+                value = stats[f"p{round(quantile * 100)}_seconds"]
+                lines.append(
+                    f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                    f"{value}"
+                )
+            lines.append(
+                f'{prefix}_stage_seconds_sum{{stage="{stage}"}} '
+                f"{stats.get('total_seconds', 0.0)}"
+            )
+            lines.append(
+                f'{prefix}_stage_seconds_count{{stage="{stage}"}} '
+                f"{sum(self.histograms[stage].values())}"
+            )
+        counter_names = sorted(
+            {name for stats in summary["stages"].values() for name in stats}
+            - {"total_seconds"}
+            - {f"p{round(quantile * 100)}_seconds" for quantile in QUANTILES}
+        )
+        for name in counter_names:
+            metric = f"{prefix}_stage_{name[len('total_'):]}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for stage, stats in summary["stages"].items():
+                if name in stats:
+                    lines.append(f'{metric}{{stage="{stage}"}} {stats[name]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """Atomically writes the Prometheus export, e.g., for a textfile collector."""
+        with open(path + ".tmp", "w", encoding="utf-8") as writer:
+            writer.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
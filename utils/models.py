@@ -0,0 +1,174 @@
+"""Utils for lazily loading models shared across RARR modules.
+
+Models are loaded once on first use so that modules importing them pay no startup cost
+unless they actually need them (e.g., search is skipped when evidence is hallucinated).
+"""
+import os
+import threading
+from typing import List, Tuple
+
+PASSAGE_RANKER_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# "torch" runs the ranker in fp32, while the other backends quantize it to int8 for
+# faster scoring on CPU. See `ranker_backends`.
+PASSAGE_RANKER_BACKENDS = ("torch", "torch_int8", "onnx_int8")
+PASSAGE_RANKER_CONFIG = {
+    "device": None,
+    "batch_size": 32,
+    "max_length": 512,
+    "backend": "torch",
+    "onnx_dir": os.path.join(os.path.expanduser("~"), ".cache", "rarr", "onnx"),
+}
+
+SPACY_MODEL_NAME = "en_core_web_sm"
+
+_PASSAGE_RANKER = None
+_SPACY_PIPELINES = {}
+_LOCK = threading.Lock()
+
+
+def configure_passage_ranker(
+    device: str = None,
+    batch_size: int = 32,
+    max_length: int = 512,
+    backend: str = "torch",
+    onnx_dir: str = None,
+) -> None:
+    """Sets the options of the passage ranker. Must be called before its first use.
+
+    The backend and device are checked right away, so that a run fails before its
+    first claim rather than on every claim.
+
+    Args:
+        device: Device to run the ranker on. If None, uses a GPU if available.
+        batch_size: Number of (query, passage) pairs scored per forward pass.
+        max_length: Maximum number of tokens of each (query, passage) pair.
+        backend: One of `PASSAGE_RANKER_BACKENDS`. The int8 backends run on CPU.
+        onnx_dir: Directory to keep the ranker exported to ONNX in. Defaults to
+            ~/.cache/rarr/onnx.
+    """
+    if _PASSAGE_RANKER is not None:
+        raise RuntimeError("The passage ranker was already loaded.")
+    check_passage_ranker_backend(backend, device)
+    if backend == "onnx_int8":
+        from utils import ranker_backends
+
+        ranker_backends.import_onnxruntime()
+    PASSAGE_RANKER_CONFIG.update(
+        device=device, batch_size=batch_size, max_length=max_length, backend=backend
+    )
+    if onnx_dir:
+        PASSAGE_RANKER_CONFIG["onnx_dir"] = onnx_dir
+
+
+def check_passage_ranker_backend(backend: str, device: str = None) -> None:
+    """Raises a `ValueError` if the backend is unknown or cannot run on the device."""
+    if backend not in PASSAGE_RANKER_BACKENDS:
+        raise ValueError(f"Unknown passage ranker backend: {backend}")
+    if backend != "torch" and device not in (None, "cpu"):
+        raise ValueError(f"The {backend} passage ranker backend only runs on CPU.")
+
+
+def load_passage_ranker(
+    backend: str = "torch", device: str = None, max_length: int = 512
+):
+    """Loads a new cross-encoder passage ranker.
+
+    Args:
+        backend: One of `PASSAGE_RANKER_BACKENDS`.
+        device: Device to run the ranker on. If None, uses a GPU if available and the
+            backend supports it.
+        max_length: Maximum number of tokens of each (query, passage) pair.
+    Returns:
+        ranker: The ranker, with the `predict` method of a `CrossEncoder`.
+    """
+    import torch
+    from sentence_transformers import CrossEncoder
+
+    check_passage_ranker_backend(backend, device)
+    if device is None:
+        use_cuda = backend == "torch" and torch.cuda.is_available()
+        device = "cuda" if use_cuda else "cpu"
+    ranker = CrossEncoder(PASSAGE_RANKER_NAME, max_length=max_length, device=device)
+
+    if backend == "torch_int8":
+        from utils import ranker_backends
+
+        return ranker_backends.quantize_cross_encoder(ranker)
+    if backend == "onnx_int8":
+        from utils import ranker_backends
+
+        onnx_path = os.path.join(
+            PASSAGE_RANKER_CONFIG["onnx_dir"],
+            PASSAGE_RANKER_NAME.replace("/", "--") + "-int8.onnx",
+        )
+        return ranker_backends.OnnxCrossEncoder(ranker, onnx_path)
+    return ranker
+
+
+def get_passage_ranker():
+    """Returns the shared cross-encoder passage ranker, loading it on first use."""
+    global _PASSAGE_RANKER
+    with _LOCK:
+        if _PASSAGE_RANKER is None:
+            _PASSAGE_RANKER = load_passage_ranker(
+                backend=PASSAGE_RANKER_CONFIG["backend"],
+                device=PASSAGE_RANKER_CONFIG["device"],
+                max_length=PASSAGE_RANKER_CONFIG["max_length"],
+            )
+    return _PASSAGE_RANKER
+
+
+def get_spacy_pipeline(sentence_splitter: str = "parser"):
+    """Returns a shared spaCy pipeline that splits text into sentences.
+
+    Args:
+        sentence_splitter: "parser" to find sentence boundaries with the dependency
+            parser of `SPACY_MODEL_NAME`, or "sentencizer" to use spaCy's much faster
+            rule-based sentencizer.
+    Returns:
+        nlp: The spaCy pipeline, loaded on first use.
+    """
+    with _LOCK:
+        if sentence_splitter not in _SPACY_PIPELINES:
+            import spacy
+
+            if sentence_splitter == "parser":
+                nlp = spacy.load(
+                    SPACY_MODEL_NAME, disable=["ner", "tagger", "lemmatizer"]
+                )
+            elif sentence_splitter == "sentencizer":
+                nlp = spacy.blank("en")
+                nlp.add_pipe("sentencizer")
+            else:
+                raise ValueError(f"Unknown spaCy splitter: {sentence_splitter}")
+            _SPACY_PIPELINES[sentence_splitter] = nlp
+    return _SPACY_PIPELINES[sentence_splitter]
+
+
+def score_passages(pairs: List[Tuple[str, str]]) -> List[float]:
+    """Scores the relevance of each (query, passage) pair with the passage ranker.
+
+    Pairs are scored in a single call sorted by length, so that each batch holds pairs
+    of similar length and little compute is wasted on padding.
+
+    Args:
+        pairs: A list of (query, passage) pairs.
+    Returns:
+        scores: The relevance score of each pair, in the same order as `pairs`.
+    """
+    if not pairs:
+        return []
+    order = sorted(range(len(pairs)), key=lambda i: sum(map(len, pairs[i])))
+    sorted_scores = (
+        get_passage_ranker()
+        .predict(
+            [pairs[i] for i in order],
+            batch_size=PASSAGE_RANKER_CONFIG["batch_size"],
+            show_progress_bar=False,
+        )
+        .tolist()
+    )
+    scores = [0.0] * len(pairs)
+    for i, score in zip(order, sorted_scores):
+        scores[i] = score
+    return scores
@@ -0,0 +1,113 @@
+"""Utils for cheaply prefiltering passages by lexical relevance before reranking.
+
+Instead of sending the first passages of a page to the cross-encoder, all passages of
+the page are scored against the query with BM25 and only the top ones are reranked.
+Passages are spans of consecutive sentences of a page, so the query term counts of each
+sentence are computed once and summed over each span with cumulative sums. The tokens
+of a page are kept as an array of hashes, which is compact enough to cache with it.
+"""
+import re
+from typing import List, Tuple
+
+import numpy as np
+
+PASSAGE_PREFILTERS = ("bm25", "position")
+TOKEN_REGEX = re.compile(r"\w+")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits text into lowercased word tokens."""
+    return TOKEN_REGEX.findall(text.lower())
+
+
+class SentenceTerms:
+    """The tokens of each sentence of a page, stored as hashes in a single array.
+
+    This takes 8 bytes per token, while a `collections.Counter` per sentence takes
+    over ten times the size of the text.
+    """
+
+    def __init__(self, sents: List[str]):
+        tokens_per_sent = [tokenize(sent) for sent in sents]
+        self.lengths = np.array([len(tokens) for tokens in tokens_per_sent], np.int64)
+        self.token_hashes = np.fromiter(
+            (hash(token) for tokens in tokens_per_sent for token in tokens),
+            dtype=np.int64,
+            count=int(self.lengths.sum()),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the number of bytes taken by the arrays."""
+        return self.lengths.nbytes + self.token_hashes.nbytes
+
+    def count_terms(self, terms: List[str]) -> np.ndarray:
+        """Counts the occurrences of each term in each sentence.
+
+        Returns:
+            term_counts: The count of each term (columns) in each sentence (rows).
+        """
+        sent_ids = np.repeat(np.arange(len(self.lengths)), self.lengths)
+        term_counts = np.zeros((len(self.lengths), len(terms)))
+        for term_idx, term in enumerate(terms):
+            term_counts[:, term_idx] = np.bincount(
+                sent_ids[self.token_hashes == hash(term)], minlength=len(self.lengths)
+            )
+        return term_counts
+
+
+def count_sentence_terms(sents: List[str]) -> SentenceTerms:
+    """Tokenizes each sentence of a page, to score it for any query."""
+    return SentenceTerms(sents)
+
+
+def score_passages_bm25(
+    query: str,
+    sent_term_counts: SentenceTerms,
+    passage_spans: List[Tuple[int, int]],
+) -> np.ndarray:
+    """Scores the passages of a page with BM25.
+
+    The document frequencies and average length are computed over the passages of the
+    page itself, so that terms repeated all over the page (e.g., its title) count less.
+
+    Args:
+        query: Search query.
+        sent_term_counts: The output of `count_sentence_terms` for the page.
+        passage_spans: The (start, end) sentence indices of each passage, e.g., from
+            `search.make_passage_spans`.
+    Returns:
+        scores: The BM25 score of each passage.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or not passage_spans:
+        return np.zeros(len(passage_spans))
+
+    # Cumulative counts of each term and of all tokens over the sentences.
+    term_counts = sent_term_counts.count_terms(terms)
+    lengths = sent_term_counts.lengths
+    cum_term_counts = np.vstack([np.zeros(len(terms)), np.cumsum(term_counts, axis=0)])
+    cum_lengths = np.concatenate([[0.0], np.cumsum(lengths)])
+
+    # Sum the counts over the sentences of each passage.
+    starts, ends = np.array(passage_spans).T
+    tf = cum_term_counts[ends] - cum_term_counts[starts]
+    passage_lengths = cum_lengths[ends] - cum_lengths[starts]
+
+    df = (tf > 0).sum(axis=0)
+    idf = np.log((len(passage_spans) - df + 0.5) / (df + 0.5) + 1)
+    avg_length = max(passage_lengths.mean(), 1.0)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * passage_lengths / avg_length)
+    return (idf * tf * (BM25_K1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+
+def select_top_passages(scores: np.ndarray, max_passages: int) -> List[int]:
+    """Selects the indices of the top scoring passages, in page order.
+
+    Ties (e.g., no passage sharing a word with the query) are broken by position, so
+    pages that do not match at all keep their first passages.
+    """
+    top = np.argsort(-scores, kind="stable")[:max_passages]
+    return sorted(top.tolist())
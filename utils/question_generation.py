@@ -1,11 +1,9 @@
 """Utils for running question generation."""
-import os
-import time
-from typing import List
+from typing import Any, Dict, List, Union
 
 import openai
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from utils import llm
 
 
 def parse_api_response(api_response: str) -> List[str]:
@@ -31,6 +29,49 @@ def parse_api_response(api_response: str) -> List[str]:
     return questions
 
 
+def make_completion_kwargs(
+    claim: str, model: str, prompt: str, temperature: float, context: str = None
+) -> Dict[str, Any]:
+    """Builds the OpenAI completion request of question generation."""
+    if context:
+        gpt3_input = prompt.format(context=context, claim=claim).strip()
+    else:
+        gpt3_input = prompt.format(claim=claim).strip()
+
+    return dict(
+        model=model,
+        prompt=gpt3_input,
+        temperature=temperature,
+        max_tokens=256,
+    )
+
+
+def parse_rounds(response_texts: List[Union[str, BaseException]]) -> List[str]:
+    """Merges the questions of all sampling rounds.
+
+    Args:
+        response_texts: The response of each round, or the error it failed with.
+    Returns:
+        questions: A sorted list of unique questions.
+    Raises:
+        openai.error.OpenAIError: If every round failed.
+    """
+    questions = set()
+    errors = []
+    for response_text in response_texts:
+        if isinstance(response_text, openai.error.OpenAIError):
+            errors.append(response_text)  # Skip rounds that keep failing.
+        elif isinstance(response_text, BaseException):
+            raise response_text
+        else:
+            questions.update(parse_api_response(response_text.strip()))
+    if errors and len(errors) == len(response_texts):
+        raise errors[-1]
+
+    questions = list(sorted(questions))
+    return questions
+
+
 def run_rarr_question_generation(
     claim: str,
     model: str,
@@ -44,6 +85,7 @@ def run_rarr_question_generation(
 
     Given a piece of text (claim), we use GPT-3 to generate questions that question the
     information in the claim. We run num_rounds of sampling to get a diverse set of questions.
+    All rounds are sampled in a single API call, so the long prompt is only sent once.
 
     Args:
         claim: Text to generate questions off of.
@@ -54,29 +96,29 @@ def run_rarr_question_generation(
     Returns:
         questions: A list of questions.
     """
-    if context:
-        gpt3_input = prompt.format(context=context, claim=claim).strip()
-    else:
-        gpt3_input = prompt.format(claim=claim).strip()
+    completion_kwargs = make_completion_kwargs(
+        claim, model, prompt, temperature, context=context
+    )
+    response_texts = llm.complete_samples(
+        completion_kwargs, num_rounds, num_retries=num_retries, retry_sleep=1
+    )
+    return parse_rounds(response_texts)
 
-    questions = set()
-    for _ in range(num_rounds):
-        for _ in range(num_retries):
-            try:
-                response = openai.Completion.create(
-                    model=model,
-                    prompt=gpt3_input,
-                    temperature=temperature,
-                    max_tokens=256,
-                )
-                cur_round_questions = parse_api_response(
-                    response.choices[0].text.strip()
-                )
-                questions.update(cur_round_questions)
-                break
-            except openai.error.OpenAIError as exception:
-                print(f"{exception}. Retrying...")
-                time.sleep(1)
 
-    questions = list(sorted(questions))
-    return questions
+async def arun_rarr_question_generation(
+    claim: str,
+    model: str,
+    prompt: str,
+    temperature: float,
+    num_rounds: int,
+    context: str = None,
+    num_retries: int = 5,
+) -> List[str]:
+    """Async version of `run_rarr_question_generation`."""
+    completion_kwargs = make_completion_kwargs(
+        claim, model, prompt, temperature, context=context
+    )
+    response_texts = await llm.acomplete_samples(
+        completion_kwargs, num_rounds, num_retries=num_retries, retry_sleep=1
+    )
+    return parse_rounds(response_texts)
@@ -0,0 +1,151 @@
+"""Quantized CPU backends for the cross-encoder passage ranker.
+
+Both backends quantize the weights of the linear layers of the ranker to int8 and
+quantize its activations dynamically, which makes scoring several times faster on CPU:
+    torch_int8: PyTorch dynamic quantization of the eager model.
+    onnx_int8: The model exported to ONNX, quantized, and run with ONNX Runtime.
+        Requires the optional `onnx` and `onnxruntime` packages. The quantized model is
+        exported once and reused from disk.
+Both keep the `predict` interface of `sentence_transformers.CrossEncoder`. Scores are
+close to but not exactly those of the fp32 ranker, see
+`benchmarks/benchmark_ranker_backends.py` to check their agreement and speed.
+"""
+import inspect
+import os
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+import torch
+
+ONNX_OPSET_VERSION = 14
+
+
+def import_onnxruntime() -> Any:
+    """Imports ONNX Runtime, with a clear error if the optional packages are missing."""
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError(
+            "The onnx_int8 ranker backend requires `pip install onnx onnxruntime`."
+        ) from e
+    return onnxruntime
+
+
+def get_activation(cross_encoder: Any) -> Callable[[torch.Tensor], torch.Tensor]:
+    """Returns the activation the cross-encoder applies to the logits of its model."""
+    activation = getattr(cross_encoder, "default_activation_function", None)
+    # Newer versions of sentence-transformers renamed the attribute.
+    return activation or cross_encoder.activation_fn
+
+
+def quantize_cross_encoder(cross_encoder: Any) -> Any:
+    """Quantizes the linear layers of a cross-encoder on CPU to int8, in place."""
+    torch.quantization.quantize_dynamic(
+        cross_encoder.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return cross_encoder
+
+
+def export_onnx(cross_encoder: Any, onnx_path: str) -> None:
+    """Exports the model of a cross-encoder to ONNX and quantizes it to int8.
+
+    Args:
+        cross_encoder: The fp32 `CrossEncoder` to export, on CPU.
+        onnx_path: File to write the quantized model to. Written atomically, so that
+            concurrent processes never load a partial export.
+    """
+    import_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+    features = cross_encoder.tokenizer(["query"], ["passage"], return_tensors="pt")
+    input_names = [
+        name
+        for name in ("input_ids", "attention_mask", "token_type_ids")
+        if name in features
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # Newer versions of PyTorch default to an exporter that needs onnxscript.
+        export_kwargs["dynamo"] = False
+    fp32_path = f"{onnx_path}.{os.getpid()}.fp32"
+    int8_path = f"{onnx_path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            cross_encoder.model.eval(),
+            (features["input_ids"], {name: features[name] for name in input_names[1:]}),
+            fp32_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes={**dynamic_axes, "logits": {0: "batch"}},
+            opset_version=ONNX_OPSET_VERSION,
+            **export_kwargs,
+        )
+    try:
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        os.replace(int8_path, onnx_path)
+    finally:
+        os.remove(fp32_path)
+
+
+class OnnxCrossEncoder:
+    """Scores (query, passage) pairs with a cross-encoder quantized to int8 in ONNX.
+
+    Tokenization and the final activation are those of the original cross-encoder, so
+    only the forward pass of its model is replaced.
+    """
+
+    def __init__(self, cross_encoder: Any, onnx_path: str):
+        """Loads the quantized model, exporting it first if it is not on disk yet.
+
+        Args:
+            cross_encoder: The fp32 `CrossEncoder` to replace, on CPU.
+            onnx_path: File of the quantized model.
+        """
+        onnxruntime = import_onnxruntime()
+        if not os.path.exists(onnx_path):
+            export_onnx(cross_encoder, onnx_path)
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [inputs.name for inputs in self.session.get_inputs()]
+        self.tokenizer = cross_encoder.tokenizer
+        self.max_length = cross_encoder.max_length
+        self.activation = get_activation(cross_encoder)
+
+    def predict(
+        self,
+        pairs: List[Tuple[str, str]],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        """Scores the pairs, as `CrossEncoder.predict`.
+
+        Args:
+            pairs: A list of (query, passage) pairs.
+            batch_size: Number of pairs scored per forward pass.
+            show_progress_bar: Unused, kept for compatibility with `CrossEncoder`.
+        Returns:
+            scores: The relevance score of each pair.
+        """
+        batch_scores = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start : start + batch_size]
+            features = self.tokenizer(
+                [query.strip() for query, _ in batch],
+                [passage.strip() for _, passage in batch],
+                padding=True,
+                truncation="longest_first",
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            inputs = {
+                name: features[name].astype(np.int64) for name in self.input_names
+            }
+            logits = self.session.run(None, inputs)[0]
+            batch_scores.append(self.activation(torch.from_numpy(logits)).numpy())
+        if not batch_scores:
+            return np.zeros(0)
+        scores = np.concatenate(batch_scores)
+        return scores[:, 0] if scores.shape[1] == 1 else scores
@@ -1,24 +1,303 @@
 """Utils for searching a query and returning top passages from search results."""
-import concurrent.futures
-import itertools
+import asyncio
+import codecs
+import collections
 import os
 import random
-from typing import Any, Dict, List, Tuple
+import re
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
 
+import aiohttp
 import bs4
-import requests
-import spacy
+import numpy as np
 import torch
-from sentence_transformers import CrossEncoder
 
-PASSAGE_RANKER = CrossEncoder(
-    "cross-encoder/ms-marco-MiniLM-L-6-v2",
-    max_length=512,
-    device="cpu",
-)
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+from utils import async_utils, cache, metrics, models, prefilter
+
 SEARCH_URL = "https://api.bing.microsoft.com/v7.0/search/"
 SUBSCRIPTION_KEY = os.getenv("AZURE_SEARCH_KEY")
-TOKENIZER = spacy.load("en_core_web_sm", disable=["ner", "tagger", "lemmatizer"])
+HTTP_CONFIG = {
+    "max_connections_per_host": 10,
+    "max_page_bytes": 5000000,  # Pages are only read up to 5MB.
+    "max_fetch_seconds": 10,
+}
+PAGE_CHUNK_BYTES = 16384
+# Responses with another declared type (e.g., PDFs, images, archives) are not read.
+SCRAPABLE_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+MAX_CHARS_TO_TOKENIZE = 500000  # Take 500k chars to not break tokenization.
+INVISIBLE_TAGS = ["style", "script", "head", "title", "meta"]
+SENTENCE_SPLITTERS = ("parser", "sentencizer", "regex")
+MAX_CACHED_SEGMENTATION_BYTES = 20000000  # Keep the sentences of ~40 long pages.
+# Abbreviations whose period does not end a sentence, e.g., "Fig. 1" or "Dr. Smith".
+NON_FINAL_ABBREVIATIONS = (
+    "Dr",
+    "Eq",
+    "Fig",
+    "Mr",
+    "Mrs",
+    "Ms",
+    "No",
+    "Sec",
+    "St",
+    "vs",
+)
+# Split on the whitespace after sentence-final punctuation, and any closing quotes or
+# brackets (which stay with their sentence), followed by what looks like a new sentence.
+# The first lookbehind only makes most positions fail fast.
+SENTENCE_BOUNDARY_REGEX = re.compile(
+    r"(?<=[.!?\"')\]])(?:(?<=[.!?])|(?<=[.!?][\"')\]])|(?<=[.!?][\"')\]]{2}))"
+    + "".join(rf"(?<!\b{abbreviation}\.)" for abbreviation in NON_FINAL_ABBREVIATIONS)
+    + r"\s+(?=[\"'(\[]*[A-Z0-9])"
+)
+
+
+_SEGMENTATION_CACHE = collections.OrderedDict()
+_SEGMENTATION_CACHE_BYTES = 0
+_SEGMENTATION_LOCK = threading.Lock()
+
+
+def configure_http(
+    max_connections_per_host: int = 10,
+    max_page_bytes: int = 5000000,
+    max_fetch_seconds: float = 10,
+) -> None:
+    """Sets the options of the shared HTTP session.
+
+    Must be called before the first search.
+
+    Args:
+        max_connections_per_host: Maximum number of open connections to each host.
+            Requests beyond it wait for a connection to be released.
+        max_page_bytes: Maximum number of bytes to download from each page. Pages
+            declaring a larger Content-Length are skipped, and the rest of pages that
+            turn out larger is ignored.
+        max_fetch_seconds: Maximum number of seconds to spend fetching each page. The
+            part of the page downloaded by then is used.
+    """
+    HTTP_CONFIG.update(
+        max_connections_per_host=max_connections_per_host,
+        max_page_bytes=max_page_bytes,
+        max_fetch_seconds=max_fetch_seconds,
+    )
+
+
+def split_sentences(
+    texts: List[str],
+    filter_sentence_len: int,
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+) -> List[List[str]]:
+    """Splits a batch of texts into sentences.
+
+    Args:
+        texts: Texts to split into sentences.
+        filter_sentence_len: Maximum number of chars of each sentence before being
+            filtered.
+        sentence_splitter: How to find sentence boundaries. One of "parser" (spaCy's
+            dependency parser, the most accurate), "sentencizer" (spaCy's rule-based
+            sentencizer) or "regex" (a punctuation-based regex, the fastest).
+        n_process: Number of processes spaCy uses to split the batch.
+    Returns:
+        sents_per_text: The sentences of each text.
+    """
+    texts = [text[:MAX_CHARS_TO_TOKENIZE] for text in texts]
+    if sentence_splitter == "regex":
+        sents_per_text = [
+            [sent for sent in SENTENCE_BOUNDARY_REGEX.split(text) if sent]
+            for text in texts
+        ]
+    elif sentence_splitter in SENTENCE_SPLITTERS:
+        nlp = models.get_spacy_pipeline(sentence_splitter)
+        try:
+            docs = list(nlp.pipe(texts, n_process=n_process))
+        except UnicodeEncodeError as _:
+            # Tokenize the texts one at a time to only skip the ones that fail.
+            docs = []
+            for text in texts:
+                try:
+                    docs.append(nlp(text))
+                except UnicodeEncodeError as _:
+                    print("Unicode error when using Spacy. Skipping text.")
+                    docs.append(None)
+        sents_per_text = [[s.text for s in doc.sents] if doc else [] for doc in docs]
+    else:
+        raise ValueError(f"Unknown sentence splitter: {sentence_splitter}")
+
+    # Long sents are usually metadata.
+    return [
+        [sent for sent in sents if len(sent) <= filter_sentence_len]
+        for sents in sents_per_text
+    ]
+
+
+def make_passage_spans(
+    num_sents: int, sentences_per_passage: int, sliding_distance: int = None
+) -> List[Tuple[int, int]]:
+    """Finds the sentences of each passage of a sliding window over a text.
+
+    Args:
+        num_sents: Number of sentences of the text.
+        sentences_per_passage: Number of sentences for each passage.
+        sliding_distance: Sliding distance over the text. Allows the passages to have
+            overlap. The sliding distance cannot be greater than the window size.
+    Returns:
+        passage_spans: The (start, end) sentence indices of each passage.
+    """
+    if not sliding_distance or sliding_distance > sentences_per_passage:
+        sliding_distance = sentences_per_passage
+    assert sentences_per_passage > 0 and sliding_distance > 0
+
+    return [
+        (idx, min(idx + sentences_per_passage, num_sents))
+        for idx in range(0, num_sents, sliding_distance)
+    ]
+
+
+def make_passages(
+    sents: List[str], sentences_per_passage: int, sliding_distance: int = None
+) -> List[str]:
+    """Groups sentences into passages using a sliding window.
+
+    Args:
+        sents: Sentences of a text.
+        sentences_per_passage: Number of sentences for each passage.
+        sliding_distance: Sliding distance over the text. Allows the passages to have
+            overlap. The sliding distance cannot be greater than the window size.
+    Returns:
+        passages: Chunked passages from the sentences.
+    """
+    return [
+        " ".join(sents[start:end])
+        for start, end in make_passage_spans(
+            len(sents), sentences_per_passage, sliding_distance
+        )
+    ]
+
+
+class Segmentation:
+    """The sentences of a text, stored as one buffer and the offsets of each sentence.
+
+    Overlapping passages share the buffer: a passage is a span of consecutive
+    sentences, and is only built as a string, with a single slice, when it is used.
+    """
+
+    def __init__(self, sents: List[str]):
+        self.text = " ".join(sents)
+        lengths = np.array([len(sent) for sent in sents], dtype=np.int64)
+        self.ends = np.cumsum(lengths + 1) - 1
+        self.starts = self.ends - lengths
+        # Tokens of each sentence, computed by the passage prefilter if needed.
+        self.sent_term_counts = None
+        self.is_cached = False
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the approximate size of the segmentation, counting a byte per char."""
+        nbytes = len(self.text) + self.starts.nbytes + self.ends.nbytes
+        if self.sent_term_counts is not None:
+            nbytes += self.sent_term_counts.nbytes
+        return nbytes
+
+    def get_sentences(self) -> List[str]:
+        """Returns the text of each sentence."""
+        return [self.text[start:end] for start, end in zip(self.starts, self.ends)]
+
+    def get_passage(self, start: int, end: int) -> str:
+        """Returns the sentences [start, end) joined by spaces, as `make_passages`."""
+        return self.text[self.starts[start] : self.ends[end - 1]]
+
+
+def get_segmentations(
+    web_texts: Dict[str, str],
+    filter_sentence_len: int,
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+) -> Dict[str, Segmentation]:
+    """Splits the text of each URL into sentences, reusing recent segmentations.
+
+    Segmentations are kept in a process-wide LRU cache of up to
+    `MAX_CACHED_SEGMENTATION_BYTES` bytes, since the same pages are often
+    returned for several claims. The texts missing from it are split in one batch.
+
+    Args:
+        web_texts: The visible text of each URL.
+        filter_sentence_len: Maximum number of chars of each sentence before being
+            filtered.
+        sentence_splitter: How to find sentence boundaries. See `split_sentences`.
+        n_process: Number of processes spaCy uses to split the batch.
+    Returns:
+        segmentations: The segmentation of the text of each URL.
+    """
+    global _SEGMENTATION_CACHE_BYTES
+    keys = {
+        url: (url, hash(text), filter_sentence_len, sentence_splitter)
+        for url, text in web_texts.items()
+    }
+    segmentations = {}
+    with _SEGMENTATION_LOCK:
+        for url, key in keys.items():
+            if key in _SEGMENTATION_CACHE:
+                _SEGMENTATION_CACHE.move_to_end(key)
+                segmentations[url] = _SEGMENTATION_CACHE[key]
+    if segmentations:
+        metrics.add("chunking", cache_hits=len(segmentations))
+
+    missing_urls = [url for url in web_texts if url not in segmentations]
+    sents_per_text = split_sentences(
+        [web_texts[url] for url in missing_urls],
+        filter_sentence_len=filter_sentence_len,
+        sentence_splitter=sentence_splitter,
+        n_process=n_process,
+    )
+    with _SEGMENTATION_LOCK:
+        for url, sents in zip(missing_urls, sents_per_text):
+            segmentations[url] = Segmentation(sents)
+            if keys[url] not in _SEGMENTATION_CACHE:
+                _SEGMENTATION_CACHE[keys[url]] = segmentations[url]
+                segmentations[url].is_cached = True
+                _SEGMENTATION_CACHE_BYTES += segmentations[url].nbytes
+        evict_segmentations()
+    return segmentations
+
+
+def evict_segmentations() -> None:
+    """Evicts the least recently used segmentations until the cache fits its limit.
+
+    Must be called with `_SEGMENTATION_LOCK` held.
+    """
+    global _SEGMENTATION_CACHE_BYTES
+    while _SEGMENTATION_CACHE_BYTES > MAX_CACHED_SEGMENTATION_BYTES:
+        _, segmentation = _SEGMENTATION_CACHE.popitem(last=False)
+        segmentation.is_cached = False
+        _SEGMENTATION_CACHE_BYTES -= segmentation.nbytes
+
+
+def get_sent_term_counts(segmentation: Segmentation) -> prefilter.SentenceTerms:
+    """Returns the tokens of each sentence of a segmentation, computing them once.
+
+    They are kept with the segmentation, and so count toward the size of the cache.
+    """
+    global _SEGMENTATION_CACHE_BYTES
+    if segmentation.sent_term_counts is None:
+        sent_term_counts = prefilter.count_sentence_terms(segmentation.get_sentences())
+        with _SEGMENTATION_LOCK:
+            if segmentation.sent_term_counts is None:
+                segmentation.sent_term_counts = sent_term_counts
+                if segmentation.is_cached:
+                    _SEGMENTATION_CACHE_BYTES += sent_term_counts.nbytes
+                    evict_segmentations()
+    return segmentation.sent_term_counts
 
 
 def chunk_text(
@@ -26,6 +305,7 @@ def chunk_text(
     sentences_per_passage: int,
     filter_sentence_len: int,
     sliding_distance: int = None,
+    sentence_splitter: str = "parser",
 ) -> List[str]:
     """Chunks text into passages using a sliding window.
 
@@ -35,27 +315,16 @@ def chunk_text(
         filter_sentence_len: Maximum number of chars of each sentence before being filtered.
         sliding_distance: Sliding distance over the text. Allows the passages to have
             overlap. The sliding distance cannot be greater than the window size.
+        sentence_splitter: How to find sentence boundaries. See `split_sentences`.
     Returns:
         passages: Chunked passages from the text.
     """
-    if not sliding_distance or sliding_distance > sentences_per_passage:
-        sliding_distance = sentences_per_passage
-    assert sentences_per_passage > 0 and sliding_distance > 0
-
-    passages = []
-    try:
-        doc = TOKENIZER(text[:500000])  # Take 500k chars to not break tokenization.
-        sents = [
-            s.text
-            for s in doc.sents
-            if len(s.text) <= filter_sentence_len  # Long sents are usually metadata.
-        ]
-        for idx in range(0, len(sents), sliding_distance):
-            passages.append(" ".join(sents[idx : idx + sentences_per_passage]))
-    except UnicodeEncodeError as _:  # Sometimes run into Unicode error when tokenizing.
-        print("Unicode error when using Spacy. Skipping text.")
-
-    return passages
+    sents = split_sentences(
+        [text],
+        filter_sentence_len=filter_sentence_len,
+        sentence_splitter=sentence_splitter,
+    )[0]
+    return make_passages(sents, sentences_per_passage, sliding_distance)
 
 
 def is_tag_visible(element: bs4.element) -> bool:
@@ -66,130 +335,422 @@ def is_tag_visible(element: bs4.element) -> bool:
     returns:
         Whether the element is visible.
     """
-    if element.parent.name in [
-        "style",
-        "script",
-        "head",
-        "title",
-        "meta",
-        "[document]",
-    ] or isinstance(element, bs4.element.Comment):
+    if element.parent.name in INVISIBLE_TAGS + ["[document]"] or isinstance(
+        element, bs4.element.Comment
+    ):
         return False
     return True
 
 
-def scrape_url(url: str, timeout: float = 3) -> Tuple[str, str]:
-    """Scrapes a URL for all text information.
+def extract_text_bs4(html: str) -> str:
+    """Extracts the visible text of an HTML page with BeautifulSoup."""
+    soup = bs4.BeautifulSoup(html, "html.parser")
+    texts = soup.findAll(text=True)
+    # Filter out invisible text from the page.
+    visible_text = filter(is_tag_visible, texts)
+    return " ".join(t.strip() for t in visible_text)
+
+
+def extract_text_lxml(html: str) -> str:
+    """Extracts the visible text of an HTML page with lxml.
+
+    Invisible subtrees and comments are dropped before traversing the tree, so their
+    text is never visited.
+    """
+    root = lxml.html.document_fromstring(html)
+    lxml.etree.strip_elements(
+        root, lxml.etree.Comment, *INVISIBLE_TAGS, with_tail=False
+    )
+    return " ".join(t.strip() for t in root.itertext())
+
+
+HTML_EXTRACTORS = {"lxml": extract_text_lxml, "bs4": extract_text_bs4}
+
+
+def check_html_extractor(html_extractor: str) -> None:
+    """Raises an error if the HTML extractor is unknown or its package is missing."""
+    if html_extractor != "auto" and html_extractor not in HTML_EXTRACTORS:
+        raise ValueError(f"Unknown HTML extractor: {html_extractor}")
+    if html_extractor == "lxml" and lxml is None:
+        raise ImportError("The lxml HTML extractor requires `pip install lxml`.")
+
+
+def extract_visible_text(html: str, html_extractor: str = "auto") -> Optional[str]:
+    """Extracts the visible text of an HTML page.
 
     Args:
-        url: URL of webpage to scrape.
-        timeout: Timeout of the requests call.
+        html: The HTML of the page.
+        html_extractor: "lxml", "bs4", or "auto" to use lxml if it is installed. If
+            lxml fails to parse the page, BeautifulSoup is used as a fallback. See
+            `check_html_extractor` for the errors raised.
     Returns:
-        web_text: The visible text of the scraped URL.
-        url: URL input.
+        web_text: The visible text of the page, or None if it could not be parsed.
     """
-    # Scrape the URL
-    try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as _:
-        return None, url
+    check_html_extractor(html_extractor)
+    if html_extractor == "auto":
+        html_extractor = "lxml" if lxml is not None else "bs4"
+    extractors = [HTML_EXTRACTORS[html_extractor]]
+    if html_extractor != "bs4":
+        extractors.append(extract_text_bs4)
 
-    # Extract out all text from the tags
-    try:
-        soup = bs4.BeautifulSoup(response.text, "html.parser")
-        texts = soup.findAll(text=True)
-        # Filter out invisible text from the page.
-        visible_text = filter(is_tag_visible, texts)
-    except Exception as _:
-        return None, url
+    for extractor in extractors:
+        try:
+            web_text = extractor(html)
+            break
+        except Exception as _:
+            continue
+    else:
+        return None
 
-    # Returns all the text concatenated as a string.
-    web_text = " ".join(t.strip() for t in visible_text).strip()
     # Clean up spacing.
-    web_text = " ".join(web_text.split())
-    return web_text, url
+    return " ".join(web_text.split())
+
+
+def is_response_scrapable(headers: Mapping[str, str], max_page_bytes: int) -> bool:
+    """Determines from its headers whether the body of a response is worth reading.
+
+    Args:
+        headers: The (case-insensitive) headers of the response.
+        max_page_bytes: Maximum number of bytes to download from the page.
+    Returns:
+        Whether the response declares a text type (or none) and a length (if any) of
+            at most `max_page_bytes`.
+    """
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type and content_type not in SCRAPABLE_CONTENT_TYPES:
+        return False
+    content_length = headers.get("Content-Length", "")
+    return not content_length.isdigit() or int(content_length) <= max_page_bytes
+
+
+class PageReader:
+    """Decodes the body of a page as it is streamed, up to a byte cap.
+
+    Chunks are decoded as they arrive, so that the raw body is never held in memory
+    alongside its text, and multi-byte characters split across chunks are decoded
+    correctly.
+    """
+
+    def __init__(self, encoding: Optional[str], max_page_bytes: int):
+        """Initializes the reader.
+
+        Args:
+            encoding: Encoding of the body. Unknown encodings fall back to UTF-8.
+            max_page_bytes: Maximum number of bytes to read.
+        """
+        try:
+            decoder_cls = codecs.getincrementaldecoder(encoding or "utf-8")
+        except LookupError as _:
+            decoder_cls = codecs.getincrementaldecoder("utf-8")
+        self.decoder = decoder_cls(errors="replace")
+        self.max_page_bytes = max_page_bytes
+        self.num_bytes = 0
+        self.texts = []
+
+    def feed(self, chunk: bytes) -> bool:
+        """Decodes the next chunk of the body.
+
+        Returns:
+            Whether to stop reading, since the byte cap is reached.
+        """
+        chunk = chunk[: self.max_page_bytes - self.num_bytes]
+        self.num_bytes += len(chunk)
+        self.texts.append(self.decoder.decode(chunk))
+        return self.num_bytes >= self.max_page_bytes
+
+    def get_text(self) -> str:
+        """Returns the text decoded so far."""
+        return "".join(self.texts) + self.decoder.decode(b"", final=True)
+
+
+async def read_page(
+    content: aiohttp.StreamReader, reader: PageReader, deadline: float
+) -> None:
+    """Feeds the body of a response to the reader until it ends or a limit is reached.
+
+    Each read only waits until the deadline, so a server trickling the page in does
+    not hold up the fetch past it, however small the pieces it sends.
+
+    Args:
+        content: The body of the response.
+        reader: The reader to feed, which stops at the byte cap.
+        deadline: `time.monotonic()` time after which no more of the body is read.
+    """
+    while True:
+        try:
+            chunk = await asyncio.wait_for(
+                content.read(PAGE_CHUNK_BYTES), deadline - time.monotonic()
+            )
+        except asyncio.TimeoutError:
+            if time.monotonic() < deadline:
+                raise  # The read timed out before the deadline.
+            return
+        if not chunk or reader.feed(chunk):
+            return
+
+
+def scrape_url(
+    url: str,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+    max_page_bytes: int = None,
+    max_fetch_seconds: float = None,
+) -> Tuple[str, str]:
+    """Scrapes a URL for all text information.
+
+    Synchronous wrapper around `ascrape_url`, see it for the arguments.
+    """
+    return async_utils.run(
+        ascrape_url(
+            url,
+            timeout=timeout,
+            html_extractor=html_extractor,
+            max_page_bytes=max_page_bytes,
+            max_fetch_seconds=max_fetch_seconds,
+        )
+    )
 
 
 def search_bing(query: str, timeout: float = 3) -> List[str]:
     """Searches the query using Bing.
+
+    Synchronous wrapper around `asearch_bing`, see it for the arguments.
+    """
+    return async_utils.run(asearch_bing(query, timeout=timeout))
+
+
+def search_queries(
+    queries: List[str],
+    cached_search_results: List[List[str]] = None,
+    timeout: float = 3,
+) -> List[List[str]]:
+    """Searches all queries concurrently.
+
+    Synchronous wrapper around `asearch_queries`, see it for the arguments.
+    """
+    return async_utils.run(
+        asearch_queries(
+            queries, cached_search_results=cached_search_results, timeout=timeout
+        )
+    )
+
+
+def is_url_scrapable(url: str) -> bool:
+    """Determines from its URL alone whether a search result is worth fetching.
+
+    PDFs are skipped since their text cannot be extracted from the HTML.
+    """
+    return ".pdf" not in url.lower()
+
+
+def get_needed_urls(
+    urls_per_query: List[List[str]],
+    web_texts: Dict[str, Optional[str]],
+    max_search_results_per_query: int,
+) -> Set[str]:
+    """Finds the unscraped URLs of the queries that do not have enough pages yet.
+
     Args:
-        query: Search query.
-        timeout: Timeout of the requests call.
+        urls_per_query: The scrapable URLs of each query.
+        web_texts: The visible text of each URL scraped so far, or None if it could
+            not be scraped.
+        max_search_results_per_query: Number of scraped pages each query needs.
     Returns:
-        search_results: A list of the top URLs relevant to the query.
+        needed_urls: The URLs that are not scraped yet and could still be used.
     """
-    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
-    params = {"q": query, "textDecorations": True, "textFormat": "HTML"}
-    response = requests.get(SEARCH_URL, headers=headers, params=params, timeout=timeout)
-    response.raise_for_status()
+    needed_urls = set()
+    for urls in urls_per_query:
+        num_scraped = sum(1 for url in urls if web_texts.get(url))
+        if num_scraped < max_search_results_per_query:
+            needed_urls.update(url for url in urls if url not in web_texts)
+    return needed_urls
 
-    response = response.json()
-    search_results = [r["url"] for r in response["webPages"]["value"]]
-    return search_results
 
+def scrape_urls(
+    urls_per_query: List[List[str]],
+    max_search_results_per_query: int,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+) -> Dict[str, Optional[str]]:
+    """Scrapes the URLs of each query until it has enough pages.
 
-def run_search(
-    query: str,
-    cached_search_results: List[str] = None,
+    Synchronous wrapper around `ascrape_urls`, see it for the arguments.
+    """
+    return async_utils.run(
+        ascrape_urls(
+            urls_per_query,
+            max_search_results_per_query=max_search_results_per_query,
+            timeout=timeout,
+            html_extractor=html_extractor,
+        )
+    )
+
+
+def fetch_search_results(
+    queries: List[str],
+    cached_search_results: List[List[str]] = None,
+    max_search_results_per_query: int = 3,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+    **chunk_kwargs: Any,
+) -> List[List[Dict[str, Any]]]:
+    """Searches the queries and chunks each scraped search result into passages.
+
+    Synchronous wrapper around `afetch_search_results`, see it for the arguments.
+    """
+    return async_utils.run(
+        afetch_search_results(
+            queries,
+            cached_search_results=cached_search_results,
+            max_search_results_per_query=max_search_results_per_query,
+            timeout=timeout,
+            html_extractor=html_extractor,
+            **chunk_kwargs,
+        )
+    )
+
+
+def chunk_search_results(
+    queries: List[str],
+    search_results_per_query: List[List[str]],
+    web_texts: Dict[str, Optional[str]],
     max_search_results_per_query: int = 3,
     max_sentences_per_passage: int = 5,
     sliding_distance: int = 1,
-    max_passages_per_search_result_to_return: int = 1,
-    timeout: float = 3,
     randomize_num_sentences: bool = False,
     filter_sentence_len: int = 250,
     max_passages_per_search_result_to_score: int = 30,
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+    passage_prefilter: str = "bm25",
+) -> List[List[Dict[str, Any]]]:
+    """Chunks the text of the scraped search results of each query into passages.
+
+    Args:
+        queries: Search queries.
+        search_results_per_query: The URLs returned for each query.
+        web_texts: The visible text of each URL, or None if it could not be scraped.
+        See `fetch_search_results` for the other arguments.
+    Returns:
+        search_results_per_query: For each query and each of its usable search
+            results, a dictionary with its URL, the number of sentences per passage,
+            and the passages to score.
+    """
+    # Remove URLs if we weren't able to scrape anything or if they are a PDF.
+    usable_urls_per_query = [
+        [url for url in urls if web_texts.get(url) and is_url_scrapable(url)][
+            :max_search_results_per_query
+        ]
+        for urls in search_results_per_query
+    ]
+
+    # Split each scraped result into sentences once, in one batch.
+    unique_urls = list(
+        dict.fromkeys(url for urls in usable_urls_per_query for url in urls)
+    )
+    segmentations = get_segmentations(
+        {url: web_texts[url] for url in unique_urls},
+        filter_sentence_len=filter_sentence_len,
+        sentence_splitter=sentence_splitter,
+        n_process=n_process,
+    )
+
+    # Chunk each scraped result into the passages to score.
+    chunked_results_per_query = []
+    for query, urls in zip(queries, usable_urls_per_query):
+        chunked_results = []
+        for url in urls:
+            if randomize_num_sentences:
+                sents_per_passage = random.randint(1, max_sentences_per_passage)
+            else:
+                sents_per_passage = max_sentences_per_passage
+
+            # Find the sentences of each passage, without building them yet.
+            segmentation = segmentations[url]
+            passage_spans = make_passage_spans(
+                len(segmentation),
+                sentences_per_passage=sents_per_passage,
+                sliding_distance=sliding_distance,
+            )
+            if (
+                passage_prefilter == "bm25"
+                and len(passage_spans) > max_passages_per_search_result_to_score
+            ):
+                # Keep the passages most lexically relevant to the query from
+                # anywhere in the page, rather than the first ones.
+                scores = prefilter.score_passages_bm25(
+                    query, get_sent_term_counts(segmentation), passage_spans
+                )
+                passage_spans = [
+                    passage_spans[idx]
+                    for idx in prefilter.select_top_passages(
+                        scores, max_passages_per_search_result_to_score
+                    )
+                ]
+            passage_spans = passage_spans[:max_passages_per_search_result_to_score]
+            if not passage_spans:
+                continue
+            chunked_results.append(
+                {
+                    "url": url,
+                    "sents_per_passage": sents_per_passage,
+                    "passages": [
+                        segmentation.get_passage(start, end)
+                        for start, end in passage_spans
+                    ],
+                }
+            )
+        chunked_results_per_query.append(chunked_results)
+    return chunked_results_per_query
+
+
+def score_search_results(
+    queries: List[str], search_results_per_query: List[List[Dict[str, Any]]]
+) -> List[List[List[float]]]:
+    """Scores the passages of all search results of all queries in one batched call.
+
+    Args:
+        queries: Search queries.
+        search_results_per_query: For each query, the output of `fetch_search_results`.
+    Returns:
+        scores: For each query and each of its search results, the cross-encoder score
+            of each passage.
+    """
+    pairs = [
+        (query, passage)
+        for query, search_results in zip(queries, search_results_per_query)
+        for result in search_results
+        for passage in result["passages"]
+    ]
+    flat_scores = iter(models.score_passages(pairs))
+
+    # Scatter the scores back to the search result each passage came from.
+    return [
+        [[next(flat_scores) for _ in result["passages"]] for result in search_results]
+        for search_results in search_results_per_query
+    ]
+
+
+def rank_search_results(
+    query: str,
+    search_results: List[Dict[str, Any]],
+    scores: List[List[float]],
+    max_passages_per_search_result_to_return: int = 1,
 ) -> List[Dict[str, Any]]:
-    """Searches the query on a search engine and returns the most relevant information.
+    """Keeps the top scoring passages of each search result as retrieved evidence.
 
     Args:
         query: Search query.
-        max_search_results_per_query: Maximum number of search results to get return.
-        max_sentences_per_passage: Maximum number of sentences for each passage.
-        filter_sentence_len: Maximum length of a sentence before being filtered.
-        sliding_distance: Sliding distance over the sentences of each search result.
-            Used to extract passages.
-        max_passages_per_search_result_to_score: Maxinum number of passages to score for
-            each search result.
+        search_results: The output of `fetch_search_results` for the query.
+        scores: The cross-encoder score of each passage of each search result.
         max_passages_per_search_result_to_return: Maximum number of passages to return
             for each search result.
     Returns:
         retrieved_passages: Top retrieved passages for the search query.
     """
-    if cached_search_results is not None:
-        search_results = cached_search_results
-    else:
-        search_results = search_bing(query, timeout=timeout)
-
-    # Scrape search results in parallel
-    with concurrent.futures.ThreadPoolExecutor() as e:
-        scraped_results = e.map(scrape_url, search_results, itertools.repeat(timeout))
-    # Remove URLs if we weren't able to scrape anything or if they are a PDF.
-    scraped_results = [r for r in scraped_results if r[0] and ".pdf" not in r[1]]
-
-    # Iterate through the scraped results and extract out the most useful passages.
     retrieved_passages = []
-    for webtext, url in scraped_results[:max_search_results_per_query]:
-        if randomize_num_sentences:
-            sents_per_passage = random.randint(1, max_sentences_per_passage)
-        else:
-            sents_per_passage = max_sentences_per_passage
-
-        # Chunk the extracted text into passages.
-        passages = chunk_text(
-            text=webtext,
-            sentences_per_passage=sents_per_passage,
-            filter_sentence_len=filter_sentence_len,
-            sliding_distance=sliding_distance,
-        )
-        passages = passages[:max_passages_per_search_result_to_score]
-        if not passages:
-            continue
-
-        # Score the passages by relevance to the query using a cross-encoder.
-        scores = PASSAGE_RANKER.predict([(query, p) for p in passages]).tolist()
-        passage_scores = list(zip(passages, scores))
+    for result, result_scores in zip(search_results, scores):
+        passage_scores = list(zip(result["passages"], result_scores))
 
         # Take the top passages_per_search passages for the current search result.
         passage_scores.sort(key=lambda x: x[1], reverse=True)
@@ -197,9 +758,9 @@ def run_search(
             retrieved_passages.append(
                 {
                     "text": passage,
-                    "url": url,
+                    "url": result["url"],
                     "query": query,
-                    "sents_per_passage": sents_per_passage,
+                    "sents_per_passage": result["sents_per_passage"],
                     "retrieval_score": score,  # Cross-encoder score as retr score
                 }
             )
@@ -217,3 +778,367 @@ def run_search(
             passage["score"] = prob
 
     return retrieved_passages
+
+
+def run_searches(queries: List[str], **kwargs: Any) -> List[List[Dict[str, Any]]]:
+    """Runs `run_search` on several queries, ranking all their passages in one batch.
+
+    Synchronous wrapper around `arun_searches`, see it for the arguments.
+    """
+    return async_utils.run(arun_searches(queries, **kwargs))
+
+
+def run_search(
+    query: str,
+    cached_search_results: List[str] = None,
+    max_search_results_per_query: int = 3,
+    max_sentences_per_passage: int = 5,
+    sliding_distance: int = 1,
+    max_passages_per_search_result_to_return: int = 1,
+    timeout: float = 3,
+    randomize_num_sentences: bool = False,
+    filter_sentence_len: int = 250,
+    max_passages_per_search_result_to_score: int = 30,
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+    html_extractor: str = "auto",
+    passage_prefilter: str = "bm25",
+) -> List[Dict[str, Any]]:
+    """Searches the query on a search engine and returns the most relevant information.
+
+    Args:
+        query: Search query.
+        cached_search_results: URLs to use instead of searching the query. If None,
+            the query is searched (or looked up in the search cache if enabled).
+        max_search_results_per_query: Maximum number of search results to get return.
+        max_sentences_per_passage: Maximum number of sentences for each passage.
+        filter_sentence_len: Maximum length of a sentence before being filtered.
+        sliding_distance: Sliding distance over the sentences of each search result.
+            Used to extract passages.
+        max_passages_per_search_result_to_score: Maxinum number of passages to score for
+            each search result.
+        sentence_splitter: How to find sentence boundaries. See `split_sentences`.
+        n_process: Number of processes spaCy uses to split sentences.
+        html_extractor: How to extract text from the HTML. See `extract_visible_text`.
+        passage_prefilter: How to choose the passages to score when a search result
+            has too many. See `afetch_search_results`.
+        max_passages_per_search_result_to_return: Maximum number of passages to return
+            for each search result.
+    Returns:
+        retrieved_passages: Top retrieved passages for the search query.
+    """
+    return run_searches(
+        queries=[query],
+        cached_search_results=[cached_search_results],
+        max_search_results_per_query=max_search_results_per_query,
+        max_sentences_per_passage=max_sentences_per_passage,
+        sliding_distance=sliding_distance,
+        max_passages_per_search_result_to_return=max_passages_per_search_result_to_return,
+        timeout=timeout,
+        randomize_num_sentences=randomize_num_sentences,
+        filter_sentence_len=filter_sentence_len,
+        max_passages_per_search_result_to_score=max_passages_per_search_result_to_score,
+        sentence_splitter=sentence_splitter,
+        n_process=n_process,
+        html_extractor=html_extractor,
+        passage_prefilter=passage_prefilter,
+    )[0]
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """Returns the HTTP session shared by all async requests of the running loop."""
+    return async_utils.get_loop_resource(
+        "aiohttp_session",
+        lambda: aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0,  # Concurrency is limited by the backend semaphores instead.
+                limit_per_host=HTTP_CONFIG["max_connections_per_host"],
+            )
+        ),
+    )
+
+
+async def ascrape_url(
+    url: str,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+    max_page_bytes: int = None,
+    max_fetch_seconds: float = None,
+) -> Tuple[str, str]:
+    """Scrapes a URL for all text information.
+
+    Limited by the "scrape" concurrency semaphore.
+
+    Args:
+        url: URL of webpage to scrape.
+        timeout: Timeout of each connection attempt and read of the request.
+        html_extractor: How to extract text from the HTML. See `extract_visible_text`.
+        max_page_bytes: Maximum number of bytes to download from the page. Defaults to
+            the value set with `configure_http`.
+        max_fetch_seconds: Maximum number of seconds to spend fetching the page.
+            Defaults to the value set with `configure_http`.
+    Returns:
+        web_text: The visible text of the scraped URL.
+        url: URL input.
+    """
+    cached_web_text = cache.get_search("page", url)
+    if cached_web_text is not None:
+        metrics.add("scrape", cache_hits=1)
+        return cached_web_text, url
+
+    max_page_bytes = max_page_bytes or HTTP_CONFIG["max_page_bytes"]
+    max_fetch_seconds = max_fetch_seconds or HTTP_CONFIG["max_fetch_seconds"]
+
+    # Scrape the URL, stopping at the byte cap or the deadline.
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+    try:
+        async with async_utils.get_semaphore("scrape"):
+            deadline = time.monotonic() + max_fetch_seconds
+            async with get_aiohttp_session().get(
+                url, timeout=client_timeout
+            ) as response:
+                response.raise_for_status()
+                if not is_response_scrapable(response.headers, max_page_bytes):
+                    metrics.add("scrape", skipped=1)
+                    return None, url
+                reader = PageReader(response.charset, max_page_bytes)
+                await read_page(response.content, reader, deadline)
+                html = reader.get_text()
+            metrics.add("scrape", num_bytes=reader.num_bytes)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as _:
+        # ValueError covers malformed URLs (e.g., a UnicodeError from a hostname label
+        # that is too long), which are as unusable as pages that fail to load.
+        return None, url
+
+    # Extract out all text from the tags
+    web_text = await async_utils.run_in_thread(
+        extract_visible_text, html, html_extractor=html_extractor
+    )
+    if web_text is None:
+        return None, url
+    cache.set_search("page", url, web_text)
+    return web_text, url
+
+
+async def asearch_bing(query: str, timeout: float = 3) -> List[str]:
+    """Searches the query using Bing, limited by the "bing" concurrency semaphore.
+
+    Args:
+        query: Search query.
+        timeout: Timeout of each connection attempt and read of the request.
+    Returns:
+        search_results: A list of the top URLs relevant to the query.
+    """
+    cached_search_results = cache.get_search("bing", query)
+    if cached_search_results is not None:
+        metrics.add("bing", cache_hits=1)
+        return cached_search_results
+
+    headers = {"Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY}
+    params = {"q": query, "textDecorations": "true", "textFormat": "HTML"}
+    client_timeout = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+    async with async_utils.get_semaphore("bing"):
+        async with get_aiohttp_session().get(
+            SEARCH_URL, headers=headers, params=params, timeout=client_timeout
+        ) as response:
+            response.raise_for_status()
+            metrics.add("bing", num_bytes=response.content_length or 0)
+            response = await response.json()
+
+    search_results = [r["url"] for r in response["webPages"]["value"]]
+    cache.set_search("bing", query, search_results)
+    return search_results
+
+
+async def asearch_queries(
+    queries: List[str],
+    cached_search_results: List[List[str]] = None,
+    timeout: float = 3,
+) -> List[List[str]]:
+    """Searches all queries concurrently.
+
+    Args:
+        queries: Search queries.
+        cached_search_results: For each query, URLs to use instead of searching it.
+        timeout: Timeout of the requests.
+    Returns:
+        search_results_per_query: The URLs returned for each query.
+    """
+    if cached_search_results is None:
+        cached_search_results = [None] * len(queries)
+    return await asyncio.gather(
+        *(
+            asearch_bing(query, timeout=timeout)
+            if cached_results is None
+            else asyncio.sleep(0, result=cached_results)
+            for query, cached_results in zip(queries, cached_search_results)
+        )
+    )
+
+
+async def ascrape_urls(
+    urls_per_query: List[List[str]],
+    max_search_results_per_query: int,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+) -> Dict[str, Optional[str]]:
+    """Scrapes the URLs of each query until it has enough pages.
+
+    Each unique URL is scraped once, concurrently. Pages are consumed as they come in,
+    and once every query using a URL has `max_search_results_per_query` pages, the
+    scrape of that URL is cancelled so that a slow host does not hold up its queries.
+
+    Args:
+        urls_per_query: The scrapable URLs of each query. May contain duplicates.
+        max_search_results_per_query: Number of scraped pages each query needs.
+        timeout: Timeout of the requests.
+        html_extractor: How to extract text from the HTML. See `extract_visible_text`.
+    Returns:
+        web_texts: The visible text of each scraped URL, or None if it could not be
+            scraped. URLs whose scrape was cancelled are missing.
+    """
+    unique_urls = list(dict.fromkeys(url for urls in urls_per_query for url in urls))
+    tasks = {
+        asyncio.ensure_future(
+            ascrape_url(url, timeout=timeout, html_extractor=html_extractor)
+        ): url
+        for url in unique_urls
+    }
+
+    web_texts = {}
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            web_texts[tasks[task]] = task.result()[0]
+
+        needed_urls = get_needed_urls(
+            urls_per_query, web_texts, max_search_results_per_query
+        )
+        unneeded = {task for task in pending if tasks[task] not in needed_urls}
+        for task in unneeded:
+            task.cancel()
+        if unneeded:
+            metrics.add("scrape", cancelled=len(unneeded))
+        pending -= unneeded
+    return web_texts
+
+
+async def afetch_search_results(
+    queries: List[str],
+    cached_search_results: List[List[str]] = None,
+    max_search_results_per_query: int = 3,
+    timeout: float = 3,
+    html_extractor: str = "auto",
+    **chunk_kwargs: Any,
+) -> List[List[Dict[str, Any]]]:
+    """Searches the queries and chunks each scraped search result into passages.
+
+    All queries are searched concurrently, and a URL returned for several queries is
+    only scraped and split into sentences once.
+
+    Args:
+        queries: Search queries.
+        cached_search_results: For each query, URLs to use instead of searching it. If
+            None, the queries are searched (or looked up in the search cache).
+        max_search_results_per_query: Maximum number of search results to get return.
+        timeout: Timeout of the requests.
+        html_extractor: How to extract text from the HTML. See `extract_visible_text`.
+        chunk_kwargs: Arguments of `chunk_search_results`, e.g., `passage_prefilter`
+            to choose how to pick the passages to score when a search result has too
+            many: "bm25" keeps the most lexically relevant ones to the query, while
+            "position" keeps the first ones.
+    Returns:
+        search_results_per_query: For each query and each of its usable search
+            results, a dictionary with its URL, the number of sentences per passage,
+            and the passages to score.
+    """
+    with metrics.track("bing", calls=len(queries)):
+        search_results_per_query = await asearch_queries(
+            queries, cached_search_results=cached_search_results, timeout=timeout
+        )
+
+    # Drop the URLs that cannot be used before fetching them.
+    search_results_per_query = [
+        [url for url in urls if is_url_scrapable(url)]
+        for urls in search_results_per_query
+    ]
+    urls = {url for urls in search_results_per_query for url in urls}
+    with metrics.track("scrape", calls=len(urls)):
+        web_texts = await ascrape_urls(
+            search_results_per_query,
+            max_search_results_per_query=max_search_results_per_query,
+            timeout=timeout,
+            html_extractor=html_extractor,
+        )
+    with metrics.track("chunking"):
+        return await async_utils.run_in_thread(
+            chunk_search_results,
+            queries,
+            search_results_per_query,
+            web_texts,
+            max_search_results_per_query=max_search_results_per_query,
+            **chunk_kwargs,
+        )
+
+
+async def arun_searches(
+    queries: List[str],
+    cached_search_results: List[List[str]] = None,
+    max_search_results_per_query: int = 3,
+    max_sentences_per_passage: int = 5,
+    sliding_distance: int = 1,
+    max_passages_per_search_result_to_return: int = 1,
+    timeout: float = 3,
+    randomize_num_sentences: bool = False,
+    filter_sentence_len: int = 250,
+    max_passages_per_search_result_to_score: int = 30,
+    sentence_splitter: str = "parser",
+    n_process: int = 1,
+    html_extractor: str = "auto",
+    passage_prefilter: str = "bm25",
+) -> List[List[Dict[str, Any]]]:
+    """Runs `run_search` on several queries, ranking all their passages in one batch.
+
+    The queries are searched concurrently and pages returned for several queries are
+    only fetched and chunked once.
+
+    Args:
+        queries: Search queries.
+        cached_search_results: For each query, URLs to use instead of searching it.
+        See `run_search` for the other arguments.
+    Returns:
+        retrieved_passages_per_query: Top retrieved passages for each search query.
+    """
+    search_results_per_query = await afetch_search_results(
+        queries=queries,
+        cached_search_results=cached_search_results,
+        timeout=timeout,
+        html_extractor=html_extractor,
+        passage_prefilter=passage_prefilter,
+        max_search_results_per_query=max_search_results_per_query,
+        max_sentences_per_passage=max_sentences_per_passage,
+        sliding_distance=sliding_distance,
+        randomize_num_sentences=randomize_num_sentences,
+        filter_sentence_len=filter_sentence_len,
+        max_passages_per_search_result_to_score=max_passages_per_search_result_to_score,
+        sentence_splitter=sentence_splitter,
+        n_process=n_process,
+    )
+
+    # Score the passages by relevance to their query using a cross-encoder.
+    with metrics.track("ranking"):
+        scores_per_query = await async_utils.run_in_thread(
+            score_search_results, queries, search_results_per_query
+        )
+    return [
+        rank_search_results(
+            query=query,
+            search_results=search_results,
+            scores=scores,
+            max_passages_per_search_result_to_return=max_passages_per_search_result_to_return,
+        )
+        for query, search_results, scores in zip(
+            queries, search_results_per_query, scores_per_query
+        )
+    ]
@@ -0,0 +1,149 @@
+"""Utils for distributing the lines of an input file among several worker processes.
+
+Workers share a SQLite file holding one row per input line. Each worker leases lines
+one at a time, and a line whose lease expires before it is marked done (e.g., because
+its worker died) can be leased again by another worker.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class WorkQueue:
+    """A thread and process-safe queue of input lines backed by a SQLite lease table."""
+
+    def __init__(self, path: str, input_path: str, lease_seconds: float = 1800) -> None:
+        """Opens (or creates) the queue and fills it with the input lines once.
+
+        Args:
+            path: Path of the SQLite file backing the queue.
+            input_path: Path of the JSONLines input file. Must be the same for all
+                workers sharing the queue.
+            lease_seconds: Number of seconds a worker has to finish a leased line
+                before it can be leased by another worker.
+        """
+        self.path = path
+        self.input_path = input_path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            "line_idx INTEGER PRIMARY KEY, byte_offset INTEGER, status TEXT, "
+            "owner TEXT, lease_expires REAL, attempts INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS queue_status ON queue(status, lease_expires)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._reader = open(input_path, "rb")
+        self._populate()
+
+    def _populate(self, batch_size: int = 10000) -> None:
+        """Adds a row for each line of the input file, unless a worker already did."""
+        with self._lock:
+            # Only one worker fills the queue, the others wait for it to finish.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                populated = self._conn.execute(
+                    "SELECT value FROM meta WHERE name = 'input_path'"
+                ).fetchone()
+                if populated is not None:
+                    if populated[0] != os.path.abspath(self.input_path):
+                        raise ValueError(
+                            f"{self.path} was created for the input {populated[0]}."
+                        )
+                else:
+                    self._insert_lines(batch_size)
+                    self._conn.execute(
+                        "INSERT INTO meta VALUES ('input_path', ?)",
+                        (os.path.abspath(self.input_path),),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _insert_lines(self, batch_size: int) -> None:
+        """Inserts the byte offset of each non-empty input line in batches."""
+        rows = []
+        offset = 0
+        line_idx = 0
+        self._reader.seek(0)
+        for raw_line in self._reader:
+            if raw_line.strip():
+                rows.append((line_idx, offset, PENDING, None, 0.0, 0))
+                line_idx += 1
+            offset += len(raw_line)
+            if len(rows) >= batch_size:
+                self._conn.executemany(
+                    "INSERT INTO queue VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+                rows = []
+        self._conn.executemany("INSERT INTO queue VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def lease(self) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Leases the next pending (or expired) line.
+
+        Returns:
+            leased: The index of the leased line and its JSON object, or None if no
+                line is left to lease.
+        """
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT line_idx, byte_offset FROM queue WHERE status = ? OR "
+                    "(status = ? AND lease_expires < ?) ORDER BY line_idx LIMIT 1",
+                    (PENDING, LEASED, now),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE queue SET status = ?, owner = ?, lease_expires = ?, "
+                        "attempts = attempts + 1 WHERE line_idx = ?",
+                        (LEASED, self.owner, now + self.lease_seconds, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            self._reader.seek(row[1])
+            return row[0], json.loads(self._reader.readline())
+
+    def complete(self, line_idx: int, failed: bool = False) -> None:
+        """Marks a leased line as done, or as failed so that it is not leased again."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE queue SET status = ?, lease_expires = NULL WHERE line_idx = ?",
+                (FAILED if failed else DONE, line_idx),
+            )
+
+    def retry_failed(self) -> None:
+        """Makes the lines that failed pending again."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE queue SET status = ? WHERE status = ?", (PENDING, FAILED)
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of lines in each status."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM queue GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}